@@ -18,10 +18,15 @@ definitely doesn't work on 1.8
 
 from __future__ import print_function, with_statement
 import gdb
+import array
+import bisect
+import codecs
 import collections
 import fractions
 import functools
+import json
 import re
+import struct
 import sys
 
 if sys.version_info[0] >= 3:
@@ -29,6 +34,8 @@ if sys.version_info[0] >= 3:
     xrange = range
     long = int
 
+# Plain memoization, for things that don't depend on anything gdb
+# knows (see CacheScope for everything else)
 def cache(f):
     memo = {}
     @functools.wraps(f)
@@ -38,6 +45,121 @@ def cache(f):
         return memo[args]
     return cached
 
+class LRUCache(object):
+    """
+    Dict-like cache holding at most maxsize entries, evicting the least
+    recently used one when it's full
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+class CacheScope(object):
+    """
+    A set of caches that go stale together.
+
+    Each scope is cleared when gdb reports one of the events it was
+    attached to, and clearing a scope also clears all of its children
+    (anything that depends on the debug info also depends on the
+    running inferior, which also depends on the current stop).
+    """
+    def __init__(self, name, parent=None):
+        self.name = name
+        self._caches = []
+        self._children = []
+        if parent is not None:
+            parent._children.append(self)
+
+    def register(self, c):
+        """Register anything with a clear() method to be cleared with this scope"""
+        self._caches.append(c)
+        return c
+
+    def invalidate(self, event=None):
+        for c in self._caches:
+            c.clear()
+        for child in self._children:
+            child.invalidate()
+
+    def connect(self, *events):
+        """Invalidate this scope on the named gdb.events, where available"""
+        if not hasattr(gdb, 'events'):
+            return
+        for name in events:
+            if hasattr(gdb.events, name):
+                getattr(gdb.events, name).connect(self.invalidate)
+
+    def memoize(self, f=None, maxsize=None):
+        """
+        Decorator like cache, except that the memo is cleared with this
+        scope and, if maxsize is given, holds at most maxsize results
+        """
+        if f is None:
+            return lambda f: self.memoize(f, maxsize)
+
+        if maxsize is None:
+            memo = self.register({})
+        else:
+            memo = self.register(LRUCache(maxsize))
+        missing = object()
+
+        @functools.wraps(f)
+        def cached(*args):
+            result = memo.get(args, missing)
+            if result is missing:
+                result = memo[args] = f(*args)
+            return result
+        return cached
+
+# Anything derived from debug info is good until gdb loads (or
+# unloads) an objfile, which might be a different Ruby entirely.
+OBJFILE_SCOPE = CacheScope('objfile')
+OBJFILE_SCOPE.connect('new_objfile', 'clear_objfiles', 'free_objfile')
+
+# Addresses of things that Ruby sets up once and never moves (but
+# which will be somewhere else next time the program is run)
+INFERIOR_SCOPE = CacheScope('inferior', OBJFILE_SCOPE)
+INFERIOR_SCOPE.connect('exited', 'new_inferior', 'inferior_deleted')
+
+# Anything else read out of the inferior's memory can change every
+# time it runs, so it's only safe to memoize until gdb resumes it.
+# Inferior function calls (e.g. "print rb_eval_string(...)") can also
+# allocate objects and symbols without an intervening stop event.
+STOP_SCOPE = CacheScope('stop', INFERIOR_SCOPE)
+STOP_SCOPE.connect('stop', 'cont', 'inferior_call', 'memory_changed')
+
+objfile_cache = OBJFILE_SCOPE.memoize
+inferior_cache = INFERIOR_SCOPE.memoize
+stop_cache = STOP_SCOPE.memoize
+
+# Wrappers for heap objects, by address. Bounded so that walking a
+# large heap doesn't hold on to every object in it.
+MAX_CACHED_OBJECTS = 50000
+object_cache = STOP_SCOPE.register(LRUCache(MAX_CACHED_OBJECTS))
+
 # ===============
 # Pretty printers
 # ===============
@@ -48,27 +170,55 @@ def cache(f):
 
 MAX_OUTPUT_LEN = 1024
 
+# How much of each string or array ruby-dump-heap includes
+DUMP_PREVIEW_LEN = 128
+
 class StringTruncated(RuntimeError):
     pass
 
 class TruncatedStringIO(object):
     '''Similar to cStringIO, but can truncate the output by raising a
     StringTruncated exception'''
-    def __init__(self, maxlen=None):
-        self._val = ''
+    def __init__(self, maxlen=None, max_depth=None):
+        self._chunks = []
+        self._len = 0
         self.maxlen = maxlen
+        # How many levels of nested containers write_repr_parts shows
+        self.max_depth = max_depth
 
     def write(self, data):
-        if self.maxlen:
-            if len(data) + len(self._val) > self.maxlen:
-                # Truncation:
-                self._val += data[0:self.maxlen - len(self._val)]
-                raise StringTruncated()
+        if self.maxlen and self._len + len(data) > self.maxlen:
+            # Truncation:
+            data = data[0:self.maxlen - self._len]
+            self._chunks.append(data)
+            self._len += len(data)
+            raise StringTruncated()
+
+        self._chunks.append(data)
+        self._len += len(data)
+
+    def remaining(self):
+        """How many more characters can be written, or None if unlimited"""
+        if not self.maxlen:
+            return None
+        return self.maxlen - self._len
 
-        self._val += data
+    def checkpoint(self):
+        """
+        Raise StringTruncated if nothing more can be written. Writers
+        call this before fetching more data from the inferior, so they
+        stop as soon as the output is full rather than at their next
+        write.
+        """
+        if self.maxlen and self._len >= self.maxlen:
+            raise StringTruncated()
 
     def getvalue(self):
-        return self._val
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        return ''.join(self._chunks)
+
+RUBY_T_NONE   = 0x00
 
 RUBY_T_OBJECT = 0x01
 RUBY_T_CLASS  = 0x02
@@ -101,77 +251,275 @@ RUBY_T_MASK   = 0x1f
 
 RUBY_SPECIAL_SHIFT = 8
 
-_void_p = gdb.lookup_type('void').pointer()
-_unsigned_long = gdb.lookup_type('unsigned long')
-_double = gdb.lookup_type('double')
-_char = gdb.lookup_type('char')
+# Type codes have been renumbered between Ruby versions, so prefer the
+# names from the debug info (see ruby_value_types) where we can get them
+RUBY_T_NAMES = dict((v, k[len('RUBY_T_'):]) for k, v in globals().items()
+                    if k.startswith('RUBY_T_') and k != 'RUBY_T_MASK')
+
+@objfile_cache
+def ruby_value_types():
+    """
+    Map from T_* type code to name (e.g. 'STRING'), from the debug
+    info's enum ruby_value_type if it's there
+    """
+    try:
+        fields = gdb.lookup_type('enum ruby_value_type').fields()
+    except (gdb.error, RuntimeError):
+        return RUBY_T_NAMES
+
+    names = {}
+    for f in fields:
+        if f.name.startswith('RUBY_T_') and f.name != 'RUBY_T_MASK':
+            names[long(f.enumval)] = f.name[len('RUBY_T_'):]
+    return names
+
+@objfile_cache
+def enum_constants(typename):
+    """
+    Map from enumerator name to value for the enum typename, or an
+    empty dict if the debug info doesn't have it. Ruby keeps many of
+    its flag and layout constants in enums for debuggers' sake.
+    """
+    try:
+        fields = gdb.lookup_type(typename).fields()
+    except (gdb.error, RuntimeError):
+        return {}
+    return dict((f.name, long(f.enumval)) for f in fields)
+
+def type_name(t):
+    return ruby_value_types().get(t, 'T_0x%x' % t)
+
+@objfile_cache
+def ruby_type_codes():
+    """Map from type name (e.g. 'ICLASS') to T_* code for this Ruby"""
+    codes = dict((name, t) for t, name in RUBY_T_NAMES.items())
+    codes.update((name, t) for t, name in ruby_value_types().items())
+    return codes
+
+def type_code(t):
+    """Translate one of the RUBY_T_* constants above into this Ruby's numbering"""
+    return ruby_type_codes().get(RUBY_T_NAMES.get(t), t)
 
 # With Ruby 2.0 and the introduction of floating-point numbers
 # ("flonums") as an immediate value type, true, false, nil, and the
-# immediate mask all changed.
-#
-# This seems to be the best way to detect (without access to macros)
-# whether or not this verison of Ruby was built with flonum support.
+# immediate mask all changed. Ruby 3.2 moved nil and undef again.
+class RubyImmediates(object):
+    """
+    How a particular Ruby build encodes special constants and
+    immediates into a VALUE, so that they can be recognized and decoded
+    from a plain Python int. The arguments are the members of Ruby's
+    enum ruby_special_consts, without the RUBY_ prefix and lowercased.
+    """
+    def __init__(self, qtrue, qnil, qundef, immediate_mask, symbol_flag,
+                 qfalse=0, fixnum_flag=0x1, flonum_mask=0x0, flonum_flag=0x2,
+                 special_shift=RUBY_SPECIAL_SHIFT):
+        self.qfalse = qfalse
+        self.qtrue = qtrue
+        self.qnil = qnil
+        self.qundef = qundef
+        self.immediate_mask = immediate_mask
+        self.fixnum_flag = fixnum_flag
+        self.flonum_mask = flonum_mask
+        self.flonum_flag = flonum_flag
+        self.symbol_flag = symbol_flag
+        self.special_shift = special_shift
+        # Static symbols have the flag in all the bits below the ID
+        self.symbol_mask = (1 << special_shift) - 1
+
+        self._specials = {
+            qfalse: RUBY_T_FALSE,
+            qnil: RUBY_T_NIL,
+            qtrue: RUBY_T_TRUE,
+            qundef: RUBY_T_UNDEF,
+        }
+
+    def __repr__(self):
+        return ('RubyImmediates(qtrue=0x%x, qnil=0x%x, qundef=0x%x, symbol_flag=0x%x)'
+                % (self.qtrue, self.qnil, self.qundef, self.symbol_flag))
+
+    def is_flonum(self, word):
+        # With no flonums, flonum_mask is 0, so this is never true
+        return word & self.flonum_mask == self.flonum_flag
+
+    def type(self, word):
+        """
+        Return the RUBY_T_* constant for word's type if it's a special
+        constant or an immediate (untranslated; see type_code), or None
+        if it's a pointer to a heap object
+        """
+        t = self._specials.get(word)
+        if t is not None:
+            return t
+        if word & self.fixnum_flag:
+            return RUBY_T_FIXNUM
+        if self.is_flonum(word):
+            return RUBY_T_FLOAT
+        if word & self.symbol_mask == self.symbol_flag:
+            return RUBY_T_SYMBOL
+        return None
+
+    def proxyval(self, word):
+        """
+        Return the proxy for word if it's a special constant or
+        immediate that can be decoded in pure Python, or NOT_IMMEDIATE
+        otherwise
+        """
+        if word == self.qfalse:
+            return False
+        if word == self.qnil:
+            return None
+        if word == self.qtrue:
+            return True
+        if word & self.fixnum_flag:
+            return fixnum_value(word)
+        if self.is_flonum(word):
+            return flonum_value(word)
+        if word & self.symbol_mask == self.symbol_flag:
+            return RubyID(word >> self.special_shift)
+        return NOT_IMMEDIATE
+
+# Profiles for when the debug info doesn't have enum
+# ruby_special_consts (see immediates)
+
+# 1.9, and 32-bit builds of 2.0 to 3.1
+PRE_FLONUM_IMMEDIATES = RubyImmediates(
+    qtrue=0x02, qnil=0x04, qundef=0x06, immediate_mask=0x03,
+    symbol_flag=0x0e)
+
+# 64-bit builds of 2.0 to 3.1
+FLONUM_IMMEDIATES = RubyImmediates(
+    qtrue=0x14, qnil=0x08, qundef=0x34, immediate_mask=0x07,
+    flonum_mask=0x03, symbol_flag=0x0c)
+
+# 32-bit builds of 3.2+
+RUBY32_PRE_FLONUM_IMMEDIATES = RubyImmediates(
+    qtrue=0x06, qnil=0x02, qundef=0x0a, immediate_mask=0x03,
+    symbol_flag=0x0e)
+
+# 64-bit builds of 3.2+
+RUBY32_FLONUM_IMMEDIATES = RubyImmediates(
+    qtrue=0x14, qnil=0x04, qundef=0x24, immediate_mask=0x07,
+    flonum_mask=0x03, symbol_flag=0x0c)
+
+# The members of enum ruby_special_consts that RubyImmediates takes
+IMMEDIATE_CONSTS = set([
+    'qfalse', 'qtrue', 'qnil', 'qundef', 'immediate_mask', 'fixnum_flag',
+    'flonum_mask', 'flonum_flag', 'symbol_flag', 'special_shift',
+])
+
+IMMEDIATE_PROFILES = [
+    PRE_FLONUM_IMMEDIATES,
+    FLONUM_IMMEDIATES,
+    RUBY32_PRE_FLONUM_IMMEDIATES,
+    RUBY32_FLONUM_IMMEDIATES,
+]
+
+# How this Ruby encodes immediates is worked out without calling into
+# the inferior if at all possible: that's slow, resumes the target, and
+# is impossible with a core file. In order of preference, it comes
+# from:
 #
-# Also, we have to use gdb.parse_and_eval so that this works on older
-# gdbs, which don't have gdb.Symbol.value() support
-@cache
+# - The debug info, which has Ruby's special constants as enum
+#   ruby_special_consts (kept there by ruby_dummy_gdb_enums in 2.0+)
+# - The version and word size, picking one of the profiles above
+# - Calling into a live process for Qtrue and Qnil, as a last resort
+
+def _immediates_from_debug_info():
+    enumerators = enum_constants('enum ruby_special_consts')
+    if not enumerators:
+        return None
+
+    consts = {}
+    for full_name, value in enumerators.items():
+        name = full_name[len('RUBY_'):].lower()
+        if full_name.startswith('RUBY_') and name in IMMEDIATE_CONSTS:
+            consts[name] = value
+    try:
+        return RubyImmediates(**consts)
+    except TypeError:
+        # Missing one that can't be defaulted
+        return None
+
+def _immediates_from_version():
+    version = ruby_version()
+    if version is None:
+        return None
+    flonum = version >= (2, 0) and word_size() >= 8
+    if version >= (3, 2):
+        if flonum:
+            return RUBY32_FLONUM_IMMEDIATES
+        return RUBY32_PRE_FLONUM_IMMEDIATES
+    if flonum:
+        return FLONUM_IMMEDIATES
+    return PRE_FLONUM_IMMEDIATES
+
+def _immediates_from_inferior():
+    if not gdb.selected_inferior().pid:
+        # A core file, or not started yet
+        return None
+    qtrue = int(gdb.parse_and_eval('rb_equal(0, 0)'))
+    # Qtrue is the same for 64-bit builds before and after 3.2
+    qnil = int(gdb.parse_and_eval('rb_ary_entry(rb_ary_new(), 0)'))
+    for profile in IMMEDIATE_PROFILES:
+        if (profile.qtrue, profile.qnil) == (qtrue, qnil):
+            return profile
+    return None
+
+@objfile_cache
+def ruby_version():
+    """
+    Return the version of the Ruby being debugged as a tuple of ints
+    (e.g. (2, 7, 1)), read from the ruby_version string in the binary,
+    or None if it can't be found
+    """
+    try:
+        version = gdb.parse_and_eval('ruby_version').string()
+    except (gdb.error, RuntimeError):
+        return None
+    match = re.match(r'(\d+)\.(\d+)(?:\.(\d+))?', version)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.groups() if part is not None)
+
+@objfile_cache
+def immediates():
+    """Return the RubyImmediates for the Ruby being debugged"""
+    for detect in (_immediates_from_debug_info, _immediates_from_version,
+                   _immediates_from_inferior):
+        profile = detect()
+        if profile is not None:
+            return profile
+    raise RuntimeError("Unable to determine how this Ruby encodes immediates")
+
 def Qtrue():
-    return int(gdb.parse_and_eval('rb_equal(0, 0)'))
+    return immediates().qtrue
 
 def Qfalse():
     return 0
 
-def Qnil(): # pragma: no cover
-    if Qtrue() == 2:
-        return 4
-    elif Qtrue() == 20:
-        return 8
-    else:
-        raise "Unable to determine Qnil from unknown value for true: %s" % Qtrue()
+def Qnil():
+    return immediates().qnil
 
-def Qundef(): # pragma: no cover
-    if Qtrue() == 2:
-        return 6
-    elif Qtrue() == 20:
-        return 52
-    else:
-        raise "Unable to determine Qundef from unknown value for true: %s" % Qtrue()
+def Qundef():
+    return immediates().qundef
 
-def IMMEDIATE_MASK(): # pragma: no cover
-    if Qtrue() == 2:
-        return 0x3
-    elif Qtrue() == 20:
-        return 0x7
-    else:
-        raise "Can't determine IMMEDIATE_MASK from unknown value for true: %s" % Qtrue()
+def IMMEDIATE_MASK():
+    return immediates().immediate_mask
 
 def FIXNUM_FLAG():
-    return 0x1
-
-def FLONUM_MASK(): # pragma: no cover
-    if Qtrue() == 2:
-        # No value ANDed with FLONUM_MASK is non-zero
-        return 0x0
-    elif Qtrue() == 20:
-        return 0x2
-    else:
-        raise "Can't determine FLONUM_MASK from unknown value for true: %s" % Qtrue()
+    return immediates().fixnum_flag
+
+def FLONUM_MASK():
+    return immediates().flonum_mask
 
 def FLONUM_FLAG():
-    return 0x2
+    return immediates().flonum_flag
 
-# This is not how Ruby does it, but I find Ruby's way confusing
 def SYMBOL_MASK():
-    return 0xff
+    return immediates().symbol_mask
 
-def SYMBOL_FLAG(): # pragma: no cover
-    if Qtrue() == 2:
-        return 0xe
-    elif Qtrue() == 20:
-        return 0xc
-    else:
-        raise "Can't determine SYMBOL_FLAG from unknown value for true: %s" % Qtrue()
+def SYMBOL_FLAG():
+    return immediates().symbol_flag
 
 def FL_USHIFT():
     return 12
@@ -179,6 +527,174 @@ def FL_USHIFT():
 def FL_USER(n):
     return 1 << (FL_USHIFT() + n)
 
+# =================
+# Raw memory access
+# =================
+#
+# Subscripting a gdb.Value is a round trip into gdb (and often into
+# the inferior) for every member. Instead, we work out where each
+# member lives from the debug info once, then read whole structs out
+# of the inferior and pick them apart with the struct module.
+
+class RubyStructLayout(object):
+    """
+    Offsets and sizes of the members of a C struct, with nested
+    structs and unions flattened into dotted paths (e.g. 'as.heap.ptr')
+    """
+    def __init__(self, gdbtype):
+        gdbtype = gdbtype.strip_typedefs()
+        self.sizeof = gdbtype.sizeof
+        self.fields = {}
+        self._probe(gdbtype, '', 0)
+
+    def _probe(self, gdbtype, prefix, base):
+        for f in gdbtype.fields():
+            # Skip static members and bitfields
+            if not hasattr(f, 'bitpos') or f.bitsize:
+                continue
+
+            t = f.type.strip_typedefs()
+            offset = base + f.bitpos // 8
+            if f.name:
+                path = prefix + f.name
+                self.fields[path] = (offset, t.sizeof)
+                path += '.'
+            else:
+                # Members of anonymous structs and unions are
+                # addressed as if they were members of the parent
+                path = prefix
+
+            if t.code in (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION):
+                self._probe(t, path, offset)
+
+    def __contains__(self, path):
+        return path in self.fields
+
+    def offset(self, path):
+        return self.fields[path][0]
+
+    def size(self, path):
+        return self.fields[path][1]
+
+@objfile_cache
+def struct_layout(typename):
+    """
+    Return the RubyStructLayout for typename, or None if the debug
+    info doesn't describe it
+    """
+    try:
+        return RubyStructLayout(gdb.lookup_type(typename))
+    except (gdb.error, RuntimeError):
+        return None
+
+@objfile_cache
+def target_byteorder():
+    if 'big endian' in gdb.execute('show endian', to_string=True):
+        return '>'
+    return '<'
+
+@objfile_cache
+def word_size():
+    return gdb.lookup_type('VALUE').sizeof
+
+_int_formats = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+def read_memory(address, length):
+    """Read length bytes of the inferior's memory as a byte string"""
+    mem = gdb.selected_inferior().read_memory(address, length)
+    if hasattr(mem, 'tobytes'):
+        return mem.tobytes()
+    return str(mem)
+
+@objfile_cache
+def word_typecode():
+    for typecode in 'ILQ':
+        try:
+            if array.array(typecode).itemsize == word_size():
+                return typecode
+        except ValueError:
+            # 'Q' is only available from Python 3.3
+            pass
+    raise RuntimeError("No array typecode for %d-byte words" % word_size())
+
+def read_words(address, count):
+    """
+    Read count consecutive VALUE-sized words with a single read, as an
+    array.array of ints in host byte order
+    """
+    words = array.array(word_typecode())
+    if count <= 0:
+        return words
+
+    data = read_memory(address, count * word_size())
+    if hasattr(words, 'frombytes'):
+        words.frombytes(data)
+    else:
+        words.fromstring(data)
+    if (target_byteorder() == '<') != (sys.byteorder == 'little'):
+        words.byteswap()
+    return words
+
+class RubyRawStruct(object):
+    """
+    A snapshot of a struct in the inferior's memory, taken with a
+    single read, whose integer and pointer members can be decoded
+    without going back to gdb
+    """
+    def __init__(self, layout, address, data=None):
+        """
+        data, if given, is the struct's bytes, already read (e.g. as
+        part of an array of them)
+        """
+        self.layout = layout
+        self.address = address
+        if data is None:
+            data = read_memory(address, layout.sizeof)
+        self.data = data
+
+    def __contains__(self, path):
+        return path in self.layout
+
+    def __getitem__(self, path):
+        offset, size = self.layout.fields[path]
+        return struct.unpack_from(target_byteorder() + _int_formats[size],
+                                  self.data, offset)[0]
+
+    def address_of(self, path):
+        return self.address + self.layout.offset(path)
+
+# ==========
+# Immediates
+# ==========
+#
+# VALUEs that aren't pointers can be decoded from the bits of the word
+# alone, without asking gdb for anything.
+
+def fixnum_value(word):
+    if word >> (word_size() * 8 - 1):
+        # Negative; VALUE is unsigned, but FIX2LONG is an arithmetic shift
+        word -= 1 << (word_size() * 8)
+    return word >> 1
+
+def flonum_value(word):
+    """Python equivalent of rb_float_flonum_value"""
+    if word == 0x8000000000000002:
+        return 0.0
+
+    b63 = word >> 63
+    t = (2 - b63) | (word & ~0x3)
+    # Rotate right by 3
+    t = ((t >> 3) | (t << 61)) & 0xffffffffffffffff
+    return struct.unpack('<d', struct.pack('<Q', t))[0]
+
+# Returned by RubyImmediates.proxyval for anything that needs a wrapper
+NOT_IMMEDIATE = object()
+
+def heap_pointers(words):
+    """Filter VALUE words down to the ones that point to heap objects"""
+    classify = immediates().type
+    return [w for w in words if classify(w) is None]
+
 class ImmediateRubyVALUE(RuntimeError):
     pass
 
@@ -191,18 +707,87 @@ class RubyVal(object):
     _typepointer = False
 
     def __init__(self, gdbval, cast_to=None):
-        if cast_to:
-            self._gdbval = gdbval.cast(cast_to)
+        """
+        gdbval can also be a plain integer (e.g. a VALUE read out of
+        memory in bulk), in which case the gdb.Value is only created
+        if something actually needs it.
+        """
+        self._value = None
+        self._address = None
+        self._cast_to = cast_to
+        self._raw = None
+
+        if isinstance(gdbval, (int, long)):
+            self._address = gdbval
+        elif cast_to:
+            self._value = gdbval.cast(cast_to)
         elif self.get_gdb_type():
-            self._gdbval = gdbval.cast(self.get_gdb_type())
+            self._value = gdbval.cast(self.get_gdb_type())
         else:
-            self._gdbval = gdbval
+            self._value = gdbval
+
+    @property
+    def _gdbval(self):
+        if self._value is None:
+            t = self._cast_to or self.get_gdb_type() or RubyVALUE.get_gdb_type()
+            self._value = gdb.Value(self._address).cast(t)
+        return self._value
 
     def as_address(self):
-        return long(self._gdbval)
+        if self._address is None:
+            self._address = long(self._value)
+        return self._address
+
+    def raw(self):
+        """
+        Return a RubyRawStruct snapshot of the struct this value points
+        to, or None if we don't know its layout
+        """
+        if self._raw is None and self._typepointer:
+            layout = struct_layout(self._typename)
+            if layout is not None:
+                self._raw = RubyRawStruct(layout, self.as_address())
+        return self._raw
+
+    def field(self, path):
+        """
+        Read an integer or pointer member (given as a dotted path) of
+        the struct this value points to, preferably from the raw
+        snapshot
+        """
+        raw = self.raw()
+        if raw is not None and path in raw:
+            return raw[path]
+
+        v = self._gdbval
+        for name in path.split('.'):
+            v = v[name]
+        return long(v)
+
+    def field_size(self, path):
+        """Return the size of a member of the struct this value points to"""
+        raw = self.raw()
+        if raw is not None and path in raw:
+            return raw.layout.size(path)
+
+        v = self._gdbval
+        for name in path.split('.'):
+            v = v[name]
+        return v.type.sizeof
+
+    def field_address(self, path):
+        """Return the address of a member of the struct this value points to"""
+        raw = self.raw()
+        if raw is not None and path in raw:
+            return raw.address_of(path)
+
+        v = self._gdbval
+        for name in path.split('.'):
+            v = v[name]
+        return long(v.address)
 
     @classmethod
-    @cache
+    @objfile_cache
     def get_gdb_type(cls):
         if cls._typename is None:
             return None
@@ -228,15 +813,23 @@ class RubyVal(object):
                 return '<%s at remote 0x%x>' % (str(self.type), self.address)
         return FakeRepr(self.as_address(), self.get_gdb_type())
 
+    # A value's repr is the same wherever it appears: at the top level
+    # or as an element of any container. nil, true and false, and
+    # containers, classes and regexps, are written Ruby-style. Numbers
+    # and strings are written as the repr of their Python proxy (e.g.
+    # 'abc', Fraction(3, 4) and (1+2j)), streamed where that's
+    # possible. The exception is a Complex with parts a Python complex
+    # can't hold exactly, written as e.g. complex(3, Fraction(1, 2)).
     def write_repr(self, out, visited):
         out.write(repr(self.proxyval(visited)))
 
-    def get_truncated_repr(self, maxlen):
+    def get_truncated_repr(self, maxlen, max_depth=None):
         '''
         Get a repr-like string for the data, but truncate it at "maxlen" bytes
-        (ending the object graph traversal as soon as you do)
+        (ending the object graph traversal as soon as you do), and at
+        "max_depth" levels of nested containers
         '''
-        out = TruncatedStringIO(maxlen)
+        out = TruncatedStringIO(maxlen, max_depth)
         try:
             self.write_repr(out, set())
         except StringTruncated:
@@ -269,60 +862,71 @@ class RubyVALUE(RubyVal):
     _typename = 'VALUE'
 
     def type(self):
-        immediate = self.as_address()
+        # deal with specials and immediates
+        t = immediates().type(self.as_address())
+        if t is not None:
+            return type_code(t)
 
-        # deal with specials
-        if immediate == Qfalse():
-            return RUBY_T_FALSE
-
-        if immediate == Qnil():
-            return RUBY_T_NIL
-
-        if immediate == Qtrue():
-            return RUBY_T_TRUE
-
-        if immediate == Qundef():
-            return RUBY_T_UNDEF
-
-        # deal with immediates
-        if immediate & FIXNUM_FLAG():
-            return RUBY_T_FIXNUM
-
-        if immediate & FLONUM_MASK() == FLONUM_FLAG():
-            return RUBY_T_FLOAT
-
-        if immediate & SYMBOL_MASK() == SYMBOL_FLAG():
-            return RUBY_T_SYMBOL
-
-        return RubyRBasic(self._gdbval).type()
+        return RubyRBasic(self.as_address()).type()
 
     def is_immediate(self):
-        return bool(IMMEDIATE_MASK() & self.as_address())
+        return bool(immediates().immediate_mask & self.as_address())
 
     @classmethod
     def subclass_from_value(cls, v):
         t = v.type()
 
         # special cases first
-        if t == RUBY_T_FLOAT:
-            if long(v._gdbval) & FLONUM_MASK() == FLONUM_FLAG():
+        if t == type_code(RUBY_T_FLOAT):
+            if immediates().is_flonum(v.as_address()):
                 return RubyFlonum
             else:
                 return RubyRFloat
 
+        # Otherwise, use the base class
+        return cls.type_dispatch().get(t, cls)
+
+    @classmethod
+    @objfile_cache
+    def type_dispatch(cls):
+        """
+        Map from T_* type code to the subclass that handles it. Only
+        types a class declares itself count, not ones it inherits.
+        Codes are translated to this Ruby's numbering (see type_code).
+        """
+        dispatch = {}
         for subclass in cls.all_subclasses():
-            if ((subclass._type and subclass._type == t) or
-                (subclass._types and t in subclass._types)):
-                return subclass
+            types = list(subclass.__dict__.get('_types', []))
+            if subclass.__dict__.get('_type'):
+                types.append(subclass._type)
+            for t in types:
+                dispatch[type_code(t)] = subclass
+        return dispatch
 
-        # Otherwise, use the base class
-        return cls
+    def is_special_const(self):
+        """Equivalent of SPECIAL_CONST_P: true for anything that isn't a pointer"""
+        return self.is_immediate() or not (self.as_address() & ~Qnil())
 
     @classmethod
     def from_value(cls, gdbval):
         """
         Try to locate the appropriate class dynamically, and cast as appropriate
+
+        Wrappers for heap objects are cached by address until the
+        inferior resumes, along with anything they've memoized
         """
+        v = RubyVALUE(gdbval)
+        if v.is_special_const():
+            return cls._from_value(gdbval)
+
+        rval = object_cache.get(v.as_address())
+        if not isinstance(rval, cls):
+            rval = cls._from_value(gdbval)
+            object_cache[v.as_address()] = rval
+        return rval
+
+    @classmethod
+    def _from_value(cls, gdbval):
         try:
             v = RubyVALUE(gdbval)
             cls = cls.subclass_from_value(v)
@@ -339,11 +943,24 @@ class RubyVALUE(RubyVal):
         return cls(gdbval)
 
     @classmethod
-    def proxyval_from_value(cls, v, visited=None):
+    def gdb_value(cls, word):
+        """Wrap a VALUE word read out of memory back up in a gdb.Value"""
+        return gdb.Value(word).cast(cls.get_gdb_type())
+
+    @classmethod
+    def proxyval_from_value(cls, v, visited=None, max_depth=None):
         if visited is None:
             visited = set()
 
-        return cls.from_value(v).proxyval(visited)
+        if isinstance(v, (int, long)):
+            proxy = immediates().proxyval(v)
+            if proxy is not NOT_IMMEDIATE:
+                return proxy
+
+        rval = cls.from_value(v)
+        if max_depth is not None and hasattr(rval, 'proxy_parts'):
+            return build_proxy(rval, visited, max_depth)
+        return rval.proxyval(visited)
 
 class ProxyAlreadyVisited(object):
     """
@@ -359,6 +976,127 @@ class ProxyAlreadyVisited(object):
     def __repr__(self):
         return self._rep
 
+# =====================
+# Walking object graphs
+# =====================
+#
+# Containers (arrays, hashes and objects) don't recurse into their
+# elements. Instead they describe themselves in pieces, and these
+# loops walk the pieces with an explicit stack, so arbitrarily deep
+# nesting (e.g. a long linked list of hashes) can't exhaust Python's
+# recursion limit.
+#
+# repr_parts(visited) is a generator of strings to write and RubyVals
+# to write in turn. proxy_parts(visited) returns (proxy, children,
+# attach): an empty proxy, the VALUE words of its elements, and a
+# function to call with each element's proxy in order. Both handle
+# visited themselves, so cycles still come out as ProxyAlreadyVisited
+# (or its repr).
+#
+# With a max_depth, both loops show at most max_depth levels of
+# containers, counting the outermost as the first; a container any
+# deeper is shown as its REPR_MARKER. So at max_depth=3, four nested
+# arrays come out as [[[[...]]]].
+
+def write_repr_parts(rval, out, visited):
+    max_depth = out.max_depth
+    stack = [rval.repr_parts(visited)]
+    while stack:
+        try:
+            part = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+
+        if isinstance(part, str):
+            out.write(part)
+            continue
+
+        out.checkpoint()
+        if not hasattr(part, 'repr_parts'):
+            part.write_repr(out, visited)
+        elif max_depth is not None and len(stack) >= max_depth:
+            out.write(part.REPR_MARKER)
+        else:
+            stack.append(part.repr_parts(visited))
+
+def build_proxy(rval, visited, max_depth=None):
+    proxy, children, attach = rval.proxy_parts(visited)
+    stack = [(iter(children), attach)]
+    while stack:
+        children, attach = stack[-1]
+        try:
+            v = next(children)
+        except StopIteration:
+            stack.pop()
+            continue
+
+        if isinstance(v, (int, long)):
+            child = immediates().proxyval(v)
+            if child is not NOT_IMMEDIATE:
+                attach(child)
+                continue
+
+        child = RubyVALUE.from_value(v)
+        if not hasattr(child, 'proxy_parts'):
+            attach(child.proxyval(visited))
+        elif max_depth is not None and len(stack) >= max_depth:
+            attach(ProxyAlreadyVisited(child.REPR_MARKER))
+        else:
+            child_proxy, grandchildren, child_attach = child.proxy_parts(visited)
+            attach(child_proxy)
+            stack.append((iter(grandchildren), child_attach))
+    return proxy
+
+# ======================
+# st_table key lookups
+# ======================
+#
+# Ruby's symbol, ID and constant tables hash their keys with functions
+# we can compute ourselves, so single lookups can go straight to the
+# right bin instead of scanning every entry.
+
+def st_numhash(n):
+    """st_numhash() from st.c (2.2+), used for ID and pointer keys"""
+    mask = (1 << (8 * word_size())) - 1
+    return ((n >> 11 | (n << 3)) ^ (n >> 3)) & mask
+
+def st_identity_hash(n):
+    """numhash() from older st.c"""
+    return n
+
+ST_HASH_FUNCTIONS = [st_numhash, st_identity_hash]
+
+def st_perturb_probe(h, mask):
+    """Bin indexes visited looking up hash h (st.c's secondary_hash)"""
+    ind = h & mask
+    perturb = h
+    while True:
+        yield ind
+        perturb >>= 11
+        ind = ((ind << 2) + ind + perturb + 1) & mask
+
+def st_quadratic_probe(h, mask):
+    """Bin indexes visited looking up hash h, if st.c uses QUADRATIC_PROBE"""
+    ind = h & mask
+    d = 1
+    while True:
+        yield ind
+        ind = (ind + d) & mask
+        d += 1
+
+ST_PROBES = [st_perturb_probe, st_quadratic_probe]
+
+# Which of ST_HASH_FUNCTIONS each st_hash_type (by address) uses, or
+# None if it's none of them (e.g. string keys)
+st_hash_functions = INFERIOR_SCOPE.register({})
+
+# Which of ST_PROBES this Ruby uses, once a lookup has confirmed it
+st_probe = OBJFILE_SCOPE.register({})
+
+# Returned by lookups that can't use the bins, so the caller has to scan
+ST_NO_INDEX = object()
+
 class RubySTTable(RubyVal):
     """
     Special wrapper class for st_table *, which Ruby uses for hashes
@@ -377,16 +1115,55 @@ class RubySTTable(RubyVal):
 
         super(RubySTTable, self).__init__(gdbval, self.get_gdb_type())
 
+    @staticmethod
+    @objfile_cache
+    def layout_kind():
+        """
+        Which of Ruby's st_table implementations this is:
+
+        'open'   - 2.4+: open addressing, with an array of entries in
+                   insertion order and a separate array of bins
+        'union'  - 2.0 to 2.3: either packed entries or a linked list
+                   of entries, in an 'as' union
+        'legacy' - 1.9: either packed bins or a linked list
+        """
+        layout = struct_layout(RubySTTable._typename)
+        if layout is not None and 'entries' in layout and 'entries_bound' in layout:
+            return 'open'
+        if layout is not None and 'as' in layout:
+            return 'union'
+        return 'legacy'
+
+    @staticmethod
+    @objfile_cache
+    def entry_layout():
+        return struct_layout('struct st_table_entry')
+
+    @staticmethod
+    def RESERVED_HASH_VAL():
+        # Marks a deleted entry in an open-addressing table
+        return (1 << (8 * word_size())) - 1
+
     def items(self):
-        new_style = 'as' in [f.name for f in self._gdbval.dereference().type.fields()]
+        """
+        Yield (key, value) for each entry in the table, as the plain
+        integers (st_data_t) stored in it
+        """
+        kind = self.layout_kind()
+        if kind == 'open':
+            for k, v in self._open_items():
+                yield k, v
+            return
+
+        new_style = kind == 'union'
         if self._gdbval['entries_packed']:
             if new_style:
                 for i in xrange(long(self._gdbval['as']['packed']['real_entries'])):
                     entry = self._gdbval['as']['packed']['entries'][i]
-                    yield entry['key'], entry['val']
+                    yield long(entry['key']), long(entry['val'])
             else:
                 for i in xrange(long(self._gdbval['num_entries'])):
-                    yield self._gdbval['bins'][i * 2], self._gdbval['bins'][i * 2 + 1]
+                    yield long(self._gdbval['bins'][i * 2]), long(self._gdbval['bins'][i * 2 + 1])
         else:
             if new_style:
                 ptr = self._gdbval['as']['big']['head']
@@ -394,21 +1171,250 @@ class RubySTTable(RubyVal):
                 ptr = self._gdbval['head']
 
             while ptr:
-                yield ptr['key'], ptr['record']
+                yield long(ptr['key']), long(ptr['record'])
                 ptr = ptr['fore']
 
+    # How many entries _open_items reads from the inferior at a time
+    ITEMS_CHUNK = 256
+
+    def _open_items(self):
+        entries = self.field('entries')
+        if not entries:
+            return
+        start = self.field('entries_start')
+        bound = self.field('entries_bound')
+
+        entry = self.entry_layout()
+        step = entry.sizeof // word_size()
+        key = entry.offset('key') // word_size()
+        record = entry.offset('record') // word_size()
+        hash = entry.offset('hash') // word_size()
+        deleted = self.RESERVED_HASH_VAL()
+
+        # Read a chunk of entries at a time, so callers that stop early
+        # (e.g. because the output is full) don't read the whole table
+        for chunk in xrange(start, bound, self.ITEMS_CHUNK):
+            count = min(self.ITEMS_CHUNK, bound - chunk)
+            words = read_words(entries + chunk * entry.sizeof, count * step)
+            for i in xrange(0, len(words), step):
+                if words[i + hash] != deleted:
+                    yield words[i + key], words[i + record]
+
+    def num_entries(self):
+        return self.field('num_entries')
+
     def __getitem__(self, needle):
+        needle = long(needle)
+        if self.layout_kind() == 'open':
+            v = self._open_lookup(needle)
+        else:
+            v = self._chained_lookup(needle)
+        if v is not ST_NO_INDEX:
+            return v
+
         for k, v in self.items():
             if k == needle:
                 return v
         raise KeyError(needle)
 
+    def hash_function(self, sample):
+        """
+        Work out which of ST_HASH_FUNCTIONS this table's type uses, by
+        checking them against a few (key, hash) pairs from its entries,
+        as returned by sample()
+        """
+        hash_type = self.field('type')
+        if hash_type not in st_hash_functions:
+            samples = sample()
+            if not samples:
+                return None
+            for f in ST_HASH_FUNCTIONS:
+                if all(f(k) == h for k, h in samples):
+                    break
+            else:
+                f = None
+            st_hash_functions[hash_type] = f
+        return st_hash_functions[hash_type]
+
+    # Values of the bins in an open-addressing table
+    EMPTY_BIN = 0
+    DELETED_BIN = 1
+    ENTRY_BASE = 2
+
+    def _open_entry(self, i):
+        """Return (hash, key, record) for entry i"""
+        entry = self.entry_layout()
+        words = read_words(self.field('entries') + i * entry.sizeof, entry.sizeof // word_size())
+        return tuple(words[entry.offset(name) // word_size()]
+                     for name in ('hash', 'key', 'record'))
+
+    def _open_samples(self, count=4):
+        samples = []
+        for i in xrange(self.field('entries_start'), self.field('entries_bound')):
+            h, k, _ = self._open_entry(i)
+            if h != self.RESERVED_HASH_VAL():
+                samples.append((k, h))
+                if len(samples) >= count:
+                    break
+        return samples
+
+    def _open_lookup(self, needle):
+        bins = self.field('bins')
+        if not bins or not self.field('num_entries'):
+            # Small tables don't have bins
+            return ST_NO_INDEX
+
+        f = self.hash_function(self._open_samples)
+        if f is None:
+            return ST_NO_INDEX
+
+        h = f(needle)
+        nbins = 1 << self.field('bin_power')
+        bin_size = 1 << self.field('size_ind')
+        probes = [st_probe['probe']] if 'probe' in st_probe else ST_PROBES
+        for probe in probes:
+            for tries, ind in enumerate(probe(h, nbins - 1)):
+                if tries >= nbins:
+                    break
+                data = read_memory(bins + ind * bin_size, bin_size)
+                b = struct.unpack(target_byteorder() + _int_formats[bin_size], data)[0]
+                if b == self.EMPTY_BIN:
+                    break
+                if b == self.DELETED_BIN:
+                    continue
+                entry_hash, k, v = self._open_entry(b - self.ENTRY_BASE)
+                if entry_hash == h and k == needle:
+                    st_probe['probe'] = probe
+                    return v
+            if 'probe' in st_probe:
+                # We know we followed the same bins Ruby would have
+                raise KeyError(needle)
+        return ST_NO_INDEX
+
+    def _chained_samples(self, count=4):
+        samples = []
+        if self.layout_kind() == 'union':
+            ptr = self._gdbval['as']['big']['head']
+        else:
+            ptr = self._gdbval['head']
+        while ptr and len(samples) < count:
+            samples.append((long(ptr['key']), long(ptr['hash'])))
+            ptr = ptr['fore']
+        return samples
+
+    def _chained_lookup(self, needle):
+        if self._gdbval['entries_packed'] or not self.field('num_entries'):
+            # Packed tables are small and have no bins
+            return ST_NO_INDEX
+
+        f = self.hash_function(self._chained_samples)
+        if f is None:
+            return ST_NO_INDEX
+
+        h = f(needle)
+        nbins = self.field('num_bins')
+        if nbins & (nbins - 1):
+            # 1.9 uses a prime number of bins
+            ind = h % nbins
+        else:
+            ind = h & (nbins - 1)
+        ptr = self._gdbval['bins'][ind]
+        while ptr:
+            if long(ptr['hash']) == h and long(ptr['key']) == needle:
+                return long(ptr['record'])
+            ptr = ptr['next']
+        raise KeyError(needle)
+
     def proxyval(self, visited):
         result = dict()
         for k, v in self.items():
             result[self.keyproxy(k)] = self.valueproxy(v)
         return result
 
+    display_hint = 'map'
+
+    def children(self):
+        st_data_t = gdb.lookup_type('st_data_t')
+        for i, (k, v) in enumerate(self.items()):
+            yield '[%d]' % i, gdb.Value(k).cast(st_data_t)
+            yield '[%d]' % i, gdb.Value(v).cast(st_data_t)
+
+class RubyIDTable(RubyVal):
+    """
+    Wrapper for struct rb_id_table * (2.3+), the open-addressing table
+    of ID keys Ruby uses for constants and methods. Keys are stored as
+    ID serial numbers, and collisions are resolved by quadratic probing.
+    """
+    _typename = 'struct rb_id_table'
+    _typepointer = True
+
+    def __init__(self, gdbval):
+        super(RubyIDTable, self).__init__(gdbval, self.get_gdb_type())
+
+    @staticmethod
+    @objfile_cache
+    def item_layout():
+        return struct_layout('struct rb_id_item')
+
+    def _items(self):
+        """Return (key, collided, value) for every bin, from a single read"""
+        capa = self.field('capa')
+        items = self.field('items')
+        if not capa or not items:
+            return []
+
+        item = self.item_layout()
+        key_offset, key_size = item.fields['key']
+        val_offset, val_size = item.fields['val']
+        key_format = target_byteorder() + _int_formats[key_size]
+        val_format = target_byteorder() + _int_formats[val_size]
+        data = read_memory(items, capa * item.sizeof)
+
+        result = []
+        for base in xrange(0, len(data), item.sizeof):
+            key = struct.unpack_from(key_format, data, base + key_offset)[0]
+            if 'collision' in item:
+                collided = struct.unpack_from(target_byteorder() + _int_formats[item.size('collision')],
+                                              data, base + item.offset('collision'))[0]
+            else:
+                # 32-bit builds keep the collision bit in the key
+                key, collided = key >> 1, key & 1
+            result.append((key, collided, struct.unpack_from(val_format, data, base + val_offset)[0]))
+        return result
+
+    def items(self):
+        """Yield (ID, value) for every entry in the table"""
+        index = RubySymbolIndex.current()
+        for key, _, v in self._items():
+            if key:
+                yield index.serial_id(key), v
+
+    def num_entries(self):
+        return self.field('num')
+
+    def __getitem__(self, needle):
+        needle = long(needle)
+        key = RubySymbolIndex.current().id_serial(needle)
+        items = self._items()
+        if not items:
+            raise KeyError(needle)
+
+        mask = len(items) - 1
+        ix = key & mask
+        d = 1
+        for _ in xrange(len(items)):
+            k, collided, v = items[ix]
+            if k == key:
+                return v
+            if not collided:
+                break
+            ix = (ix + d) & mask
+            d += 1
+        raise KeyError(needle)
+
+    def proxyval(self, visited):
+        return dict(self.items())
+
 # Immediates and other specials:
 
 class RubyFixnum(RubyVALUE):
@@ -417,25 +1423,18 @@ class RubyFixnum(RubyVALUE):
     """
     _type = RUBY_T_FIXNUM
     def proxyval(self, visited):
-        return self.as_address() >> 1
+        return fixnum_value(self.as_address())
+
+    def write_repr(self, out, visited):
+        out.write('%d' % fixnum_value(self.as_address()))
 
 class RubyFlonum(RubyVALUE):
     """
     Class wrapping immediate floating-point numbers (not RFloats)
     """
     # Don't specify _type because RubyVALUE will handle the dispatch
-    def rotr(self, v, b):
-        return (v >> b) | (v << ((v.type.sizeof * 8) - 3))
-
     def proxyval(self, visited):
-        if self._gdbval == gdb.Value(0x8000000000000002):
-            return 0.0
-        else:
-            v = self._gdbval.cast(_unsigned_long)
-            b63 = v >> 63
-            t = (2 - b63) | (v & ~3)
-            t = self.rotr(t, 3)
-            return float(t.cast(_void_p).cast(_double))
+        return flonum_value(self.as_address())
 
 class RubyNil(RubyVALUE):
     _type = RUBY_T_NIL
@@ -461,27 +1460,130 @@ class RubyFalse(RubyVALUE):
     def write_repr(self, out, visited):
         out.write('false')
 
+class RubySymbolIndex(object):
+    """
+    Two-way map between IDs and the strings they name, built by a
+    single pass over the inferior's symbol table.
+
+    Ruby has stored its symbols two different ways: older versions
+    keep an st_table (global_symbols.id_str) mapping IDs to strings,
+    and 2.2+ keeps global_symbols.ids, an array of arrays of
+    alternating (string, symbol) entries indexed by ID serial number.
+    """
+    # Number of VALUEs per symbol in each global_symbols.ids entry
+    ID_ENTRY_SIZE = 2
+
+    def __init__(self, global_symbols):
+        self._strings = {}
+        self._serials = {}
+        self._serial_ids = {}
+        self._ids = {}
+
+        if 'id_str' in [f.name for f in global_symbols.type.fields()]:
+            self._index_id_str(global_symbols['id_str'])
+        else:
+            self._index_ids(global_symbols['ids'])
+
+    @classmethod
+    @stop_cache
+    def current(cls):
+        return cls(RubyID.global_symbols())
+
+    def _index_id_str(self, id_str):
+        for k, v in RubySTTable(id_str).items():
+            s = RubyVALUE.proxyval_from_value(v)
+            self._strings[long(k)] = s
+            self._ids.setdefault(s, long(k))
+
+    def _index_ids(self, ids):
+        ids = RubyVALUE.from_value(ids)
+        id_entry_unit = None
+        for idx, entry in enumerate(ids.values()):
+            ary = RubyVALUE.from_value(entry).values()
+            if id_entry_unit is None:
+                id_entry_unit = len(ary) // self.ID_ENTRY_SIZE
+            for i in xrange(0, len(ary), self.ID_ENTRY_SIZE):
+                s = RubyVALUE.proxyval_from_value(ary[i])
+                if not isinstance(s, str):
+                    # Unused serial number
+                    continue
+                serial = idx * id_entry_unit + i // self.ID_ENTRY_SIZE
+                self._serials[serial] = s
+
+                id = self._symbol_id(long(ary[i + 1]))
+                if id is not None:
+                    self._strings[id] = s
+                    self._serial_ids[serial] = id
+                    self._ids.setdefault(s, id)
+
+    @staticmethod
+    def _symbol_id(sym):
+        if sym & SYMBOL_MASK() == SYMBOL_FLAG():
+            return sym >> immediates().special_shift
+        try:
+            # Dynamic symbols are heap objects that carry their ID
+            rsym = gdb.Value(sym).cast(gdb.lookup_type('struct RSymbol').pointer())
+            return long(rsym['id'])
+        except (gdb.error, RuntimeError):
+            return None
+
+    def string(self, id):
+        """Return the string for the given ID, or None if it doesn't exist"""
+        s = self._strings.get(id)
+        if s is None:
+            s = self._serials.get(id >> RubyID.ID_SCOPE_SHIFT())
+        return s
+
+    def id(self, s):
+        """Return the ID for the given string, or None if it isn't interned"""
+        return self._ids.get(s)
+
+    def serial_id(self, serial):
+        """
+        Return the ID with the given serial number. Operator IDs (and
+        anything we don't know about) are their own serial number.
+        """
+        return self._serial_ids.get(serial, serial)
+
+    def id_serial(self, id):
+        """The inverse of serial_id"""
+        serial = id >> RubyID.ID_SCOPE_SHIFT()
+        if self._serial_ids.get(serial) == id:
+            return serial
+        return id
+
 class RubyID(RubyVal):
     _typename = 'ID'
 
-    # TODO: Even in Ruby 2.2 (where symbols are GC'd), once a given ID
-    # is assigned it's never reused, so we could do a lot of caching
-    # here for efficiency
+    # The symbol table's name, newest Rubies first: recent versions
+    # export it as ruby_global_symbols, older ones keep it static
+    GLOBAL_SYMBOLS_EXPRESSIONS = ['ruby_global_symbols', 'global_symbols']
+
+    @classmethod
+    @objfile_cache
+    def global_symbols_expression(cls):
+        for expr in cls.GLOBAL_SYMBOLS_EXPRESSIONS:
+            try:
+                gdb.parse_and_eval(expr)
+            except (gdb.error, RuntimeError):
+                continue
+            return expr
+        raise RuntimeError("Can't find Ruby's symbol table")
 
     @staticmethod
-    @cache
+    @stop_cache
     def global_symbols():
-        return gdb.parse_and_eval('global_symbols')
+        return gdb.parse_and_eval(RubyID.global_symbols_expression())
 
     @staticmethod
     def ID_SCOPE_SHIFT():
         return 4
 
     def __long__(self):
-        return long(self._gdbval)
+        return long(self.as_address())
 
     def __int__(self):
-        return int(self._gdbval)
+        return int(self.as_address())
 
     def __str__(self):
         return self.string(set())
@@ -490,21 +1592,13 @@ class RubyID(RubyVal):
         return ':' + str(self)
 
     def string(self, visited):
-        global_symbols = RubyID.global_symbols()
         try:
-            if 'id_str' in [f.name for f in global_symbols.type.fields()]:
-                table = RubySTTable(global_symbols['id_str'])
-                return RubyVALUE.proxyval_from_value(table[self._gdbval], visited)
-            else:
-                serial = self._gdbval >> self.ID_SCOPE_SHIFT()
-                ids = RubyVALUE.from_value(global_symbols['ids'])
-                id_entry_unit = RubyVALUE.from_value(ids[0]).length() / 2
-
-                idx = serial / id_entry_unit
-                ary = RubyVALUE.from_value(ids[idx])
-                return RubyVALUE.proxyval_from_value(ary[(serial % id_entry_unit) * 2], visited)
-        except:
+            s = RubySymbolIndex.current().string(long(self))
+        except (gdb.error, RuntimeError):
+            s = None
+        if s is None:
             return "<Unknown symbol ID 0x%x>" % long(self)
+        return s
 
     def proxyval(self, visited):
         return ':' + self.string(visited)
@@ -514,22 +1608,11 @@ class RubySymbol(RubyVALUE):
 
     @classmethod
     def intern(cls, s):
-        global_symbols = RubyID.global_symbols()
-        if 'id_str' in [f.name for f in global_symbols.type.fields()]:
-            table = RubySTTable(global_symbols['id_str'])
-            for k, v in table.items():
-                if RubyVALUE.proxyval_from_value(v) == s:
-                    return k
-        else:
-            ids = RubyVALUE.from_value(global_symbols['ids'])
-            for idx in xrange(long(ids.length())):
-                ary = RubyVALUE.from_value(ids[idx])
-                for i in xrange(0, long(ary.length()), 2):
-                    if RubyVALUE.proxyval_from_value(ary[i]) == s:
-                        return ary[i + 1]
+        """Return the ID for the string s, or None if it isn't interned"""
+        return RubySymbolIndex.current().id(s)
 
     def sym2id(self):
-        return RubyID(self._gdbval >> RUBY_SPECIAL_SHIFT)
+        return RubyID(self.as_address() >> immediates().special_shift)
 
     def proxyval(self, visited):
         return self.sym2id()
@@ -543,23 +1626,125 @@ class RubyRBasic(RubyVALUE):
     _typename = 'struct RBasic'
     _typepointer = True
 
+    _class_name = None
+
     def flags(self):
         if self.is_immediate():
             raise ImmediateRubyVALUE(self)
 
-        return long(self._gdbval.cast(RubyRBasic.get_gdb_type()).dereference()['flags'])
+        if self._typename == RubyRBasic._typename:
+            return self.field('flags')
+        return self.field('basic.flags')
 
     def type(self):
         return self.flags() & RUBY_T_MASK
 
     def klass(self):
-        return self._gdbval['basic']['klass']
+        return self.field('basic.klass')
+
+    def klass_wrapper(self):
+        klass = RubyVALUE.from_value(self.klass())
+        if not isinstance(klass, RubyRClass):
+            klass = RubyRClass(self.klass())
+        return klass
+
+    def class_name(self):
+        if self._class_name is None:
+            self._class_name = self.klass_wrapper().real_class().name()
+        return self._class_name
+
+    def references(self):
+        """
+        Return the addresses of the heap objects this object refers to
+        (other than its class)
+        """
+        return []
+
+    def dump_fields(self, record):
+        """Add type-specific fields to an ObjectSpace.dump-style record"""
+        pass
 
 class RubyRFloat(RubyRBasic):
     _typename = 'struct RFloat'
     def proxyval(self, visited):
         return float(self._gdbval.dereference()['float_value'])
 
+# =============
+# Object shapes
+# =============
+#
+# From 3.2, classes no longer map ivar names to indexes. Instead each
+# object has a shape, whose ID is kept in the top half of its flags on
+# 64-bit builds. Shapes form a tree: each one adds one ivar (or
+# records something else, like freezing) to its parent. Walking up to
+# the root gives the object's ivars and where each one is stored.
+
+# Where the shapes are, newest Rubies first
+SHAPE_LIST_EXPRESSIONS = [
+    'rb_shape_tree_ptr->shape_list',
+    'ruby_current_vm_ptr->shape_list',
+]
+
+# enum shape_type, for debug info without it
+SHAPE_TYPES = {'SHAPE_IVAR': 1, 'SHAPE_OBJ_TOO_COMPLEX': 6}
+
+ROOT_SHAPE_ID = 0
+SHAPE_ID_BITS = 32
+
+# Shapes never change once created, but a program can create a lot
+MAX_CACHED_SHAPES = 10000
+
+@objfile_cache
+def shape_layout():
+    """Return the layout of rb_shape_t, or None before 3.2"""
+    return struct_layout('rb_shape_t') or struct_layout('struct rb_shape')
+
+@objfile_cache
+def shape_type(name):
+    return enum_constants('enum shape_type').get(name, SHAPE_TYPES.get(name))
+
+@inferior_cache
+def shape_list():
+    for expr in SHAPE_LIST_EXPRESSIONS:
+        try:
+            address = long(gdb.parse_and_eval(expr))
+        except (gdb.error, RuntimeError):
+            continue
+        if address:
+            return address
+    raise RuntimeError("Can't find Ruby's object shapes")
+
+def object_shape_id(flags):
+    if word_size() * 8 <= SHAPE_ID_BITS:
+        # 32-bit builds keep it somewhere we don't know how to find
+        raise RuntimeError("Can't find object shapes on 32-bit builds")
+    return flags >> (word_size() * 8 - SHAPE_ID_BITS)
+
+@inferior_cache(maxsize=MAX_CACHED_SHAPES)
+def shape_ivars(shape_id):
+    """
+    Return (too_complex, ivars) for a shape: whether objects with it
+    keep their ivars in an st_table instead, and otherwise a tuple of
+    (ID, index) for each ivar, in the order they were set
+    """
+    layout = shape_layout()
+    shapes = shape_list()
+    ivars = []
+    seen = set()
+    while shape_id != ROOT_SHAPE_ID and shape_id < (1 << SHAPE_ID_BITS) - 1:
+        if shape_id in seen:
+            raise RuntimeError('Loop in the shape tree at shape %d' % (shape_id,))
+        seen.add(shape_id)
+
+        shape = RubyRawStruct(layout, shapes + shape_id * layout.sizeof)
+        if shape['type'] == shape_type('SHAPE_OBJ_TOO_COMPLEX'):
+            return True, ()
+        if shape['type'] == shape_type('SHAPE_IVAR'):
+            ivars.append((shape['edge_name'], shape['next_iv_index'] - 1))
+        shape_id = shape['parent_id']
+    ivars.reverse()
+    return False, tuple(ivars)
+
 class RubyRObject(RubyRBasic):
     _type = RUBY_T_OBJECT
     _typename = 'struct RObject'
@@ -571,49 +1756,123 @@ class RubyRObject(RubyRBasic):
     def iv_index_tbl(self):
         return RubyRClass(self.klass()).real_class().iv_index_tbl()
 
+    @staticmethod
+    def iv_index(v):
+        """
+        Decode a value from an iv_index_tbl: the index itself, or (in
+        3.0 and 3.1) a pointer to a struct rb_iv_index_tbl_entry
+        """
+        layout = struct_layout('struct rb_iv_index_tbl_entry')
+        if layout is None:
+            return v
+        return RubyRawStruct(layout, v)['index']
+
     def ivptr(self):
+        """Return the address of the object's array of ivar values"""
+        if self.flags() & self.ROBJECT_EMBED():
+            return self.field_address('as.ary')
+        else:
+            return self.field('as.heap.ivptr')
+
+    def shape(self):
+        """Return shape_ivars() for this object's shape (3.2+ only)"""
+        return shape_ivars(object_shape_id(self.flags()))
+
+    def iv_hash(self):
+        """The st_table of ivars of an object with a too complex shape"""
+        return RubySTTable(self.field('as.heap.ivptr'))
+
+    def numiv(self):
+        if shape_layout() is not None:
+            too_complex, ivars = self.shape()
+            if too_complex:
+                return self.iv_hash().num_entries()
+            return len(ivars)
         if self.flags() & self.ROBJECT_EMBED():
-            return self._gdbval['as']['ary']
+            return self.field_size('as.ary') // word_size()
         else:
-            return self._gdbval['as']['heap']['ivptr']
+            return self.field('as.heap.numiv')
 
     def ivars(self):
-        # TODO: bounds-check the indexes in iv_index_tbl
-        ivptr = self.ivptr()
-        iv_index_tbl = RubySTTable(self.iv_index_tbl())
-        if iv_index_tbl.as_address():
-            for k, v in iv_index_tbl.items():
-                if ivptr[v] != Qundef():
-                    yield RubyID(k), RubyVALUE.from_value(ivptr[v])
+        """
+        Yield (RubyID, RubyVALUE) for each of the object's ivars. Raises
+        RuntimeError if this Ruby keeps them somewhere we can't read.
+        """
+        if shape_layout() is not None:
+            too_complex, ivars = self.shape()
+            if too_complex:
+                for k, v in self.iv_hash().items():
+                    yield RubyID(k), RubyVALUE.from_value(v)
+                return
+            values = read_words(self.ivptr(), len(ivars))
+            for k, index in ivars:
+                if values[index] != Qundef():
+                    yield RubyID(k), RubyVALUE.from_value(values[index])
+            return
 
-    def write_repr(self, out, visited):
-        if self.as_address() in visited:
-            out.write('<...>')
+        if RubyRClass.layout()['iv_index_tbl'] is None:
+            raise RuntimeError("Can't find where this Ruby keeps ivars")
+        iv_index_tbl = RubySTTable(self.iv_index_tbl())
+        if not iv_index_tbl.as_address():
             return
-        visited.add(self.as_address())
 
-        out.write('<')
-        out.write(RubyRClass(self.klass()).name())
-        for k, v in self.ivars():
-            out.write(' ')
-            out.write(str(k))
-            out.write('=')
-            v.write_repr(out, visited)
-        out.write('>')
+        values = read_words(self.ivptr(), self.numiv())
+        for k, v in iv_index_tbl.items():
+            index = self.iv_index(v)
+            if index < len(values) and values[index] != Qundef():
+                yield RubyID(k), RubyVALUE.from_value(values[index])
 
-class RubyRClass(RubyRBasic):
-    _types = [RUBY_T_CLASS, RUBY_T_MODULE, RUBY_T_ICLASS]
-    _typename = 'struct RClass'
+    def references(self):
+        if shape_layout() is not None and self.shape()[0]:
+            return heap_pointers([v for _, v in self.iv_hash().items()])
+        return heap_pointers(read_words(self.ivptr(), self.numiv()))
 
-    _name_cache = {}
+    def dump_fields(self, record):
+        record['ivars'] = self.numiv()
+
+    display_hint = None
+
+    def children(self):
+        for k, v in self.ivars():
+            yield str(k), RubyVALUE.gdb_value(v.as_address())
+
+    REPR_MARKER = '<...>'
+
+    def repr_parts(self, visited):
+        if self.as_address() in visited:
+            yield self.REPR_MARKER
+            return
+        visited.add(self.as_address())
+
+        yield '<'
+        yield self.class_name()
+        try:
+            ivars = list(self.ivars())
+        except RuntimeError:
+            # Don't make it look as if there aren't any
+            yield ' (ivars unavailable)'
+            ivars = []
+        for k, v in ivars:
+            yield ' '
+            yield str(k)
+            yield '='
+            yield v
+        yield '>'
+
+    def write_repr(self, out, visited):
+        write_repr_parts(self, out, visited)
+
+class RubyRClass(RubyRBasic):
+    _types = [RUBY_T_CLASS, RUBY_T_MODULE, RUBY_T_ICLASS]
+    _typename = 'struct RClass'
 
     # Strategy: self->ptr->iv_tbl hopefully includes a :__classpath__
-    # hidden variable. If that's not there, we have to do a search of
-    # the constant tree (starting from the constants over Object) and
-    # discover it.
+    # hidden variable. If that's not there, we have to look the class
+    # up in the constant tree (starting from the constants over
+    # Object); see RubyClassPathIndex.
 
     @staticmethod
-    @cache
+    @stop_cache
     def classpathSymbol():
         return RubySymbol.intern('__classpath__')
 
@@ -622,95 +1881,196 @@ class RubyRClass(RubyRBasic):
         return FL_USER(0)
 
     @staticmethod
-    @cache
+    @stop_cache
     def cObject():
         return RubyVALUE.from_value(gdb.parse_and_eval('rb_cObject'))
 
+    @staticmethod
+    @objfile_cache
+    def layout():
+        """
+        Work out where this Ruby keeps each part of a class, from the
+        debug info. Returns a dict mapping 'super', 'iv_index_tbl',
+        'iv_tbl' and 'const_tbl' to whether they're members of the
+        RClass ('class') or of its rb_classext_t ('ext'), or None if
+        this Ruby doesn't have them; 'iv_tbl_kind' and
+        'const_tbl_kind' to the wrapper for that table; and 'ext' to
+        'ptr' if the rb_classext_t is pointed to by the RClass, or
+        'embedded' if it comes right after it (3.1+).
+        """
+        def members(t):
+            return dict((f.name, f.type) for f in t.strip_typedefs().fields())
+
+        rclass = members(gdb.lookup_type('struct RClass'))
+        ext = members(gdb.lookup_type('rb_classext_t'))
+
+        layout = {'ext': 'ptr' if 'ptr' in rclass else 'embedded'}
+        for name in ('super', 'iv_index_tbl', 'iv_tbl', 'const_tbl'):
+            if name in rclass:
+                layout[name] = 'class'
+                t = rclass[name]
+            elif name in ext:
+                layout[name] = 'ext'
+                t = ext[name]
+            else:
+                layout[name] = None
+                continue
+
+            if 'rb_id_table' in str(t.strip_typedefs()):
+                layout[name + '_kind'] = RubyIDTable
+            else:
+                layout[name + '_kind'] = RubySTTable
+        return layout
+
+    def ext(self):
+        """Return a RubyRawStruct of the class's rb_classext_t"""
+        if self.layout()['ext'] == 'ptr':
+            address = self.field('ptr')
+        else:
+            address = self.as_address() + struct_layout(self._typename).sizeof
+        return RubyRawStruct(struct_layout('rb_classext_t'), address)
+
+    def member(self, name):
+        """Read one of the members described by layout()"""
+        where = self.layout()[name]
+        if where == 'class':
+            return self.field(name)
+        elif where == 'ext':
+            return self.ext()[name]
+        return 0
+
+    def table(self, name):
+        """Wrap the iv_tbl or const_tbl, or return None if there isn't one"""
+        address = self.member(name)
+        if not address:
+            return None
+        return self.layout()[name + '_kind'](address)
+
     def real_class(self):
         cls = self
         while cls.flags() & self.FL_SINGLETON():
-            cls = RubyRClass(self._gdbval['super'])
+            cls = RubyRClass(cls.member('super'))
         return cls
 
     def iv_index_tbl(self):
-        try:
-            return self._gdbval['ptr']['iv_index_tbl']
-        except gdb.error as e:
-            if e.args[0] != 'There is no member named iv_index_tbl.':
-                raise
-            return self._gdbval['iv_index_tbl']
+        return self.member('iv_index_tbl')
 
-    def constants(self):
-        tbl = self._gdbval['ptr']['const_tbl']
-        if not tbl:
-            return None
-        return RubySTTable(tbl)
-
-    def classpath(self):
-        table = RubySTTable(self._gdbval['ptr']['iv_tbl'])
-        if not table.as_address():
-            table = {}
-        return table[self.classpathSymbol()]
+    def iv_table(self):
+        return self.table('iv_tbl')
 
-    @staticmethod
-    @cache
-    def rb_const_entry_t():
-        return gdb.lookup_type('rb_const_entry_t')
-
-    def search_for_class(self, target, visited=None):
-        if visited is None:
-            visited = set([self.as_address()])
+    def constants(self):
+        return self.table('const_tbl')
 
+    def constant_values(self):
+        """Yield (ID, VALUE) for each of the module's constants"""
         constants = self.constants()
         if constants is None:
-            return None
+            return
 
         for k, v in constants.items():
-            value = v.cast(self.rb_const_entry_t().pointer())['value']
+            yield k, self.const_entry_value(v)
 
-            if long(value) == target.as_address():
-                return str(RubyID(k))
+    def references(self):
+        refs = [long(v) for _, v in self.constant_values()]
+        table = self.iv_table()
+        if table is not None:
+            refs.extend(long(v) for _, v in table.items())
+        return heap_pointers(refs)
 
-            if long(value) in visited:
-                continue
-            visited.add(long(value))
+    def dump_fields(self, record):
+        if self.type() != type_code(RUBY_T_ICLASS):
+            record['name'] = self.name()
 
-            if RubyVALUE(value).type() in [RUBY_T_CLASS, RUBY_T_MODULE]:
-                child = RubyRClass(value).search_for_class(target, visited)
-                if child is not None:
-                    return '%s::%s' % (RubyID(k), child)
+    def classpath(self):
+        table = self.iv_table()
+        if table is None or self.classpathSymbol() is None:
+            raise KeyError('__classpath__')
+        return table[self.classpathSymbol()]
+
+    @staticmethod
+    def const_entry_value(entry):
+        """Return the VALUE in the rb_const_entry_t at address entry"""
+        layout = struct_layout('rb_const_entry_t')
+        return RubyRawStruct(layout, entry)['value']
 
     def validate_name(self, name):
         rmod = self.cObject()
         try:
             for elt in name.split('::'):
-                v = rmod.constants()[RubySymbol.intern(elt) >> RUBY_SPECIAL_SHIFT]
-                mod = v.cast(self.rb_const_entry_t().pointer())['value']
-                rmod = RubyVALUE.from_value(mod)
+                id = RubySymbol.intern(elt)
+                if id is None:
+                    return False
+                v = rmod.constants()[id]
+                rmod = RubyVALUE.from_value(self.const_entry_value(v))
             return True
         except KeyError:
             return False
 
     def name(self):
+        index = RubyClassPathIndex.current()
+        address = self.as_address()
+        if address in index.resolved:
+            return index.resolved[address]
+
         try:
-            return RubyVALUE.proxyval_from_value(self.classpath())
+            name = RubyVALUE.proxyval_from_value(self.classpath())
         except KeyError:
-            if (self.as_address() in self._name_cache and
-                self.validate_name(self._name_cache[self.as_address()])):
-                return self._name_cache[self.as_address()]
+            name = index.get(address)
+        if name is None:
+            name = "%s:0x%x" % ("Module" if self.type() == type_code(RUBY_T_MODULE) else "Class", address)
 
-            search = self.cObject().search_for_class(self)
-            if search is None:
-                return "%s:0x%s" % ("Module" if self.type() == RUBY_T_MODULE else "Class", self.as_address())
-            else:
-                self._name_cache[self.as_address()] = search
-                return search
+        index.resolved[address] = name
+        return name
 
     def write_repr(self, out, visited):
         out.write('#<')
         out.write(self.name())
         out.write('>')
 
+class RubyClassPathIndex(object):
+    """
+    Map from the address of every class and module reachable through
+    the constant tree to its fully-qualified name.
+
+    The tree is walked breadth-first, once, the first time a name is
+    needed during a stop, so each class gets the shortest path it can
+    be reached by. Names resolved by RubyRClass.name() (however they
+    were found) are also remembered here until the inferior resumes.
+    """
+    def __init__(self):
+        self.resolved = {}
+        self._names = None
+
+    @classmethod
+    @stop_cache
+    def current(cls):
+        return cls()
+
+    def get(self, address):
+        if self._names is None:
+            self._names = self._walk(RubyRClass.cObject())
+        return self._names.get(address)
+
+    @staticmethod
+    def _walk(root):
+        names = {}
+        queue = collections.deque([(root, None)])
+        while queue:
+            mod, prefix = queue.popleft()
+            for k, value in mod.constant_values():
+                if long(value) in names:
+                    continue
+                if RubyVALUE(value).type() not in [type_code(RUBY_T_CLASS), type_code(RUBY_T_MODULE)]:
+                    continue
+
+                if prefix is None:
+                    name = str(RubyID(k))
+                else:
+                    name = '%s::%s' % (prefix, RubyID(k))
+                names[long(value)] = name
+                queue.append((RubyRClass(value), name))
+        return names
+
 class RubyRString(RubyRBasic):
     _type = RUBY_T_STRING
     _typename = 'struct RString'
@@ -719,18 +2079,173 @@ class RubyRString(RubyRBasic):
     def RSTRING_NOEMBED():
         return FL_USER(1)
 
-    def __str__(self):
+    @staticmethod
+    def STR_SHARED():
+        return FL_USER(2)
+
+    @staticmethod
+    @objfile_cache
+    def embed_ary_path():
+        """Where an embedded string's bytes are: as.embed.ary in 3.1+"""
+        layout = struct_layout('struct RString')
+        if layout is not None and 'as.embed.ary' in layout:
+            return 'as.embed.ary'
+        return 'as.ary'
+
+    def ptr(self):
+        if self.flags() & RubyRString.RSTRING_NOEMBED():
+            return self.field('as.heap.ptr')
+        else:
+            return self.field_address(self.embed_ary_path())
+
+    def length(self):
+        raw = self.raw()
+        if raw is not None and 'len' in raw:
+            # Ruby 3.2+ keeps the length outside the union
+            return raw['len']
         if self.flags() & RubyRString.RSTRING_NOEMBED():
-            ptr = self._gdbval['as']['heap']['ptr']
-            length = self._gdbval['as']['heap']['len']
+            return self.field('as.heap.len')
+        elif raw is not None and 'as.embed.len' in raw:
+            # 3.1 built with variable width allocation
+            return raw['as.embed.len']
         else:
-            ptr = self._gdbval['as']['ary']
-            length = (self.flags() >> (2 + FL_USHIFT())) & 31
-        return ptr.cast(_char.array(long(length)).pointer()).dereference().string()
+            return (self.flags() >> (2 + FL_USHIFT())) & 31
+
+    def contents(self, maxlen=None):
+        """Read the string's bytes, or only the first maxlen of them"""
+        length = self.length()
+        if maxlen is not None:
+            length = min(length, maxlen)
+        return read_memory(self.ptr(), length)
+
+    # Strings are read this many bytes at a time by save()
+    SAVE_CHUNK = 1 << 20
+
+    def save(self, f):
+        """
+        Write the string's bytes to the binary file f, a chunk at a
+        time, and return how many were written
+        """
+        ptr = self.ptr()
+        length = self.length()
+        for start in xrange(0, length, self.SAVE_CHUNK):
+            f.write(read_memory(ptr + start, min(self.SAVE_CHUNK, length - start)))
+        return length
+
+    @staticmethod
+    def ENCODING_SHIFT():
+        return FL_USHIFT() + 10
+
+    # Encoding indexes this high are stored in an ivar instead
+    ENCODING_INLINE_MAX = 127
+
+    def encoding(self):
+        """Return the name of the string's encoding, or None if we can't tell"""
+        index = (self.flags() >> self.ENCODING_SHIFT()) & self.ENCODING_INLINE_MAX
+        return encoding_name(index)
+
+    def decode(self, data):
+        """
+        Decode bytes read from this string according to its encoding,
+        replacing anything invalid in it. Binary and US-ASCII strings
+        decode as latin-1, so every byte maps to one character. On
+        Python 2 the bytes are returned as they are.
+        """
+        if sys.version_info[0] < 3:
+            return data
+        return data.decode(python_codec(self.encoding()), 'replace')
+
+    def references(self):
+        flags = self.flags()
+        if flags & RubyRString.RSTRING_NOEMBED() and flags & RubyRString.STR_SHARED():
+            return heap_pointers([self.field('as.heap.aux.shared')])
+        return []
+
+    def dump_fields(self, record):
+        record['bytesize'] = self.length()
+        record['value'] = self.decode(self.contents(DUMP_PREVIEW_LEN))
+
+    _str = None
+
+    # Wrappers stay in object_cache for the whole stop, so only short
+    # strings (names, mostly) keep their contents memoized with them
+    MAX_MEMOIZED_LEN = 256
+
+    def __str__(self):
+        if self._str is not None:
+            return self._str
+        data = self.decode(self.contents())
+        if len(data) <= self.MAX_MEMOIZED_LEN:
+            self._str = data
+        return data
 
     def proxyval(self, visited):
         return str(self)
 
+    def write_repr(self, out, visited):
+        # Every character of output comes from at most 4 bytes of
+        # input, so that's all we need to fill the remaining output
+        remaining = out.remaining()
+        maxlen = None if remaining is None else 4 * remaining + 4
+        # The same decoding as proxyval, so both give the same repr
+        out.write(repr(self.decode(self.contents(maxlen))))
+
+# Ruby's first three encodings always have the same indexes
+BUILTIN_ENCODINGS = {0: 'ASCII-8BIT', 1: 'UTF-8', 2: 'US-ASCII'}
+BINARY_ENCODINGS = ('ASCII-8BIT', 'US-ASCII')
+
+# Where the table of encodings lives, in order of Ruby version
+ENCODING_NAME_EXPRESSIONS = [
+    'global_enc_table.list[%d].enc->name',
+    'enc_table.list[%d].enc->name',
+]
+
+@stop_cache
+def encoding_name(index):
+    """Return the name of the encoding with the given index, or None"""
+    if index in BUILTIN_ENCODINGS:
+        return BUILTIN_ENCODINGS[index]
+    for expr in ENCODING_NAME_EXPRESSIONS:
+        try:
+            return gdb.parse_and_eval(expr % (index,)).string()
+        except (gdb.error, RuntimeError):
+            continue
+    return None
+
+def python_codec(name):
+    """Return the Python codec for a Ruby encoding name, falling back to UTF-8"""
+    if name in BINARY_ENCODINGS:
+        return 'latin-1'
+    try:
+        return codecs.lookup(name).name
+    except (LookupError, TypeError):
+        return 'utf-8'
+
+class RubySaveStringCommand(gdb.Command):
+    """Write the contents of a Ruby string to FILE.
+
+Usage: ruby-save-string EXPR FILE
+
+The string is copied out of the inferior a chunk at a time, so even
+very large strings don't have to fit in gdb's memory."""
+
+    def __init__(self):
+        super(RubySaveStringCommand, self).__init__('ruby-save-string', gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        args = gdb.string_to_argv(arg)
+        if len(args) != 2:
+            raise gdb.GdbError('Usage: ruby-save-string EXPR FILE')
+
+        rval = RubyVALUE.from_value(gdb.parse_and_eval(args[0]))
+        if not isinstance(rval, RubyRString):
+            raise gdb.GdbError('%s is not a Ruby string' % (args[0],))
+        with open(args[1], 'wb') as f:
+            length = rval.save(f)
+        print('Wrote %d bytes to %s' % (length, args[1]))
+
+RubySaveStringCommand()
+
 class RubyRArray(RubyRBasic):
     _type = RUBY_T_ARRAY
     _typename = 'struct RArray'
@@ -740,31 +2255,103 @@ class RubyRArray(RubyRBasic):
         return FL_USER(1)
 
     def array(self):
+        """Return the address of the array's elements"""
         if self.flags() & RubyRArray.RARRAY_EMBED_FLAG():
-            return self._gdbval['as']['ary']
+            return self.field_address('as.ary')
         else:
-            return self._gdbval['as']['heap']['ptr']
+            return self.field('as.heap.ptr')
+
+    @staticmethod
+    @objfile_cache
+    def embed_len_field():
+        """
+        Return (mask, shift) of an embedded array's length in its
+        flags. 3.2+ widened it, so it's read from the debug info where
+        possible.
+        """
+        consts = dict(enum_constants('enum ruby_rarray_flags'))
+        consts.update(enum_constants('enum ruby_rarray_consts'))
+        if 'RARRAY_EMBED_LEN_MASK' in consts and 'RARRAY_EMBED_LEN_SHIFT' in consts:
+            return consts['RARRAY_EMBED_LEN_MASK'], consts['RARRAY_EMBED_LEN_SHIFT']
+        return FL_USER(4) | FL_USER(3), FL_USHIFT() + 3
 
     def length(self):
         if self.flags() & RubyRArray.RARRAY_EMBED_FLAG():
-            return (self.flags() >> (3 + FL_USHIFT())) & 3
+            mask, shift = self.embed_len_field()
+            return (self.flags() & mask) >> shift
         else:
-            return self._gdbval['as']['heap']['len']
+            return self.field('as.heap.len')
+
+    def values(self):
+        """
+        Read all of the array's elements at once, as an array.array of
+        VALUE words
+        """
+        return read_words(self.array(), self.length())
 
     def __getitem__(self, i):
-        if i > self.length():
+        if i >= self.length():
             raise IndexError("list index out of range")
-        return self.array()[i]
+        return read_words(self.array() + i * word_size(), 1)[0]
 
-    def proxyval(self, visited):
+    REPR_MARKER = '[...]'
+
+    def proxy_parts(self, visited):
         if self.as_address() in visited:
-            return ProxyAlreadyVisited('[...]')
+            return ProxyAlreadyVisited(self.REPR_MARKER), (), None
         visited.add(self.as_address())
 
+        result = []
+        return result, self.values(), result.append
+
+    def proxyval(self, visited):
+        return build_proxy(self, visited)
+
+    def references(self):
+        return heap_pointers(self.values())
+
+    def dump_fields(self, record):
+        record['length'] = self.length()
+        record['preview'] = self.get_truncated_repr(DUMP_PREVIEW_LEN)
+
+    display_hint = 'array'
+
+    # How many elements are read from the inferior at a time by
+    # chunks(), and so by children() and write_repr()
+    CHILDREN_CHUNK = 256
+
+    def chunks(self):
+        """Yield (start index, array.array of elements) a chunk at a time"""
         ary = self.array()
         length = self.length()
-        return [RubyVALUE.proxyval_from_value(ary[i], visited)
-                for i in xrange(long(length))]
+        for start in xrange(0, length, self.CHILDREN_CHUNK):
+            count = min(self.CHILDREN_CHUNK, length - start)
+            yield start, read_words(ary + start * word_size(), count)
+
+    def children(self):
+        for start, chunk in self.chunks():
+            for i, v in enumerate(chunk):
+                yield '[%d]' % (start + i), RubyVALUE.gdb_value(v)
+
+    def repr_parts(self, visited):
+        if self.as_address() in visited:
+            yield self.REPR_MARKER
+            return
+        visited.add(self.as_address())
+
+        yield '['
+        first = True
+        for start, chunk in self.chunks():
+            for v in chunk:
+                if first:
+                    first = False
+                else:
+                    yield ', '
+                yield RubyVALUE.from_value(v)
+        yield ']'
+
+    def write_repr(self, out, visited):
+        write_repr_parts(self, out, visited)
 
 class RubyRRegexp(RubyRBasic):
     _type = RUBY_T_REGEXP
@@ -787,6 +2374,9 @@ class RubyRRegexp(RubyRBasic):
         return re.compile(RubyVALUE.proxyval_from_value(self._gdbval['src'], visited),
                           flags)
 
+    def references(self):
+        return heap_pointers([long(self._gdbval['src'])])
+
     def write_repr(self, out, visited):
         src = RubyVALUE.proxyval_from_value(self._gdbval['src'], visited)
         if '/' in src:
@@ -805,49 +2395,172 @@ class RubyRRegexp(RubyRBasic):
         if opts & self.ONIG_OPTION_MULTILINE:
             out.write('m')
 
+class RubyARTable(object):
+    """
+    The array table (2.7+) Ruby uses for hashes of up to 8 entries:
+    a flat array of (key, value) pairs, where deleted pairs have a key
+    of Qundef
+    """
+    def __init__(self, address, bound, size):
+        self.address = address
+        self.bound = bound
+        self.size = size
+
+    @staticmethod
+    @objfile_cache
+    def pairs_offset():
+        layout = struct_layout('struct ar_table_struct')
+        if layout is not None and 'pairs' in layout:
+            # 3.x puts an array of hints in front of the pairs
+            return layout.offset('pairs')
+        return 0
+
+    def items(self):
+        words = read_words(self.address + self.pairs_offset(), self.bound * 2)
+        undef = Qundef()
+        for i in xrange(0, len(words), 2):
+            if words[i] != undef:
+                yield words[i], words[i + 1]
+
+    def num_entries(self):
+        return self.size
+
+    def __getitem__(self, needle):
+        needle = long(needle)
+        for k, v in self.items():
+            if k == needle:
+                return v
+        raise KeyError(needle)
+
 class RubyRHash(RubyRBasic):
     _type = RUBY_T_HASH
     _typename = 'struct RHash'
 
-    def items(self):
-        return RubySTTable(self._gdbval['ntbl']).items()
+    @staticmethod
+    def RHASH_ST_TABLE_FLAG():
+        return FL_USER(3)
 
-    def proxyval(self, visited):
-        if self.as_address() in visited:
-            return ProxyAlreadyVisited('{...}')
-        visited.add(self.as_address())
+    @staticmethod
+    def RHASH_AR_TABLE_SIZE(flags):
+        return (flags >> (FL_USHIFT() + 4)) & 0xf
+
+    @staticmethod
+    def RHASH_AR_TABLE_BOUND(flags):
+        return (flags >> (FL_USHIFT() + 8)) & 0xf
 
-        if not self._gdbval['ntbl']:
-            return {}
+    @staticmethod
+    @objfile_cache
+    def layout_kind():
+        """
+        Where this Ruby keeps a hash's table:
 
-        result = {}
+        'ntbl'     - up to 2.6: an st_table pointer, NULL when empty
+        'as'       - 2.7 to 3.2: an st_table or ar_table pointer
+        'embedded' - 3.3+: an st_table or ar_table right after the RHash
+        """
+        layout = struct_layout(RubyRHash._typename)
+        if layout is None or 'ntbl' in layout:
+            return 'ntbl'
+        if 'as.st' in layout:
+            return 'as'
+        return 'embedded'
+
+    def table(self):
+        """
+        Return the hash's RubySTTable or RubyARTable, or None if it
+        hasn't allocated one
+        """
+        kind = self.layout_kind()
+        if kind == 'ntbl':
+            ntbl = self.field('ntbl')
+            return RubySTTable(ntbl) if ntbl else None
+
+        flags = self.flags()
+        if kind == 'as':
+            address = self.field('as.st')
+        else:
+            address = self.as_address() + struct_layout(self._typename).sizeof
+        if not address:
+            return None
+        if flags & self.RHASH_ST_TABLE_FLAG():
+            return RubySTTable(address)
+        return RubyARTable(address, self.RHASH_AR_TABLE_BOUND(flags),
+                           self.RHASH_AR_TABLE_SIZE(flags))
+
+    def items(self):
+        table = self.table()
+        if table is None:
+            return iter(())
+        return table.items()
+
+    def size(self):
+        table = self.table()
+        if table is None:
+            return 0
+        return table.num_entries()
+
+    def references(self):
+        refs = []
         for k, v in self.items():
-            k = RubyVALUE.proxyval_from_value(k, visited)
-            v = RubyVALUE.proxyval_from_value(v, visited)
-            result[k] = v
-        return result
+            refs.append(k)
+            refs.append(v)
+        return heap_pointers(refs)
 
-    def write_repr(self, out, visited):
+    def dump_fields(self, record):
+        record['size'] = self.size()
+
+    REPR_MARKER = '{...}'
+
+    def proxy_parts(self, visited):
         if self.as_address() in visited:
-            out.write('{...}')
-            return
+            return ProxyAlreadyVisited(self.REPR_MARKER), (), None
         visited.add(self.as_address())
 
-        out.write('{')
+        result = {}
+        keys = []
+        def attach(proxy):
+            # Called with the key's proxy, then the value's
+            if keys:
+                result[keys.pop()] = proxy
+            else:
+                keys.append(proxy)
 
-        if self._gdbval['ntbl']:
-            first = True
+        def children():
             for k, v in self.items():
-                if first:
-                    first = False
-                else:
-                    out.write(', ')
+                yield k
+                yield v
+        return result, children(), attach
+
+    def proxyval(self, visited):
+        return build_proxy(self, visited)
 
-                RubyVALUE.from_value(k).write_repr(out, visited)
-                out.write(' => ')
-                RubyVALUE.from_value(v).write_repr(out, visited)
+    display_hint = 'map'
 
-        out.write('}')
+    def children(self):
+        for i, (k, v) in enumerate(self.items()):
+            yield '[%d]' % i, RubyVALUE.gdb_value(k)
+            yield '[%d]' % i, RubyVALUE.gdb_value(v)
+
+    def repr_parts(self, visited):
+        if self.as_address() in visited:
+            yield self.REPR_MARKER
+            return
+        visited.add(self.as_address())
+
+        yield '{'
+        first = True
+        for k, v in self.items():
+            if first:
+                first = False
+            else:
+                yield ', '
+            yield RubyVALUE.from_value(k)
+            yield ' => '
+            yield RubyVALUE.from_value(v)
+        yield '}'
+
+    def write_repr(self, out, visited):
+        write_repr_parts(self, out, visited)
 
 class RubyRFile(RubyRBasic):
     _type = RUBY_T_FILE
@@ -859,7 +2572,7 @@ class RubyRFile(RubyRBasic):
             return super(RubyRFile, self).write_repr(out, visited)
 
         out.write('#<')
-        out.write(RubyRClass(self.klass()).name())
+        out.write(self.class_name())
         out.write(':')
         path = RubyVALUE.proxyval_from_value(fptr['pathv'], visited)
         if path:
@@ -876,34 +2589,1309 @@ class RubyRRational(RubyRBasic):
     _type = RUBY_T_RATIONAL
     _typename = 'struct RRational'
 
+    def references(self):
+        return heap_pointers([self.field('num'), self.field('den')])
+
     def proxyval(self, visited):
-        num = RubyVALUE.proxyval_from_value(self._gdbval['num'], visited)
-        den = RubyVALUE.proxyval_from_value(self._gdbval['den'], visited)
+        num = RubyVALUE.proxyval_from_value(self.field('num'), visited)
+        den = RubyVALUE.proxyval_from_value(self.field('den'), visited)
         return fractions.Fraction(num, den)
 
+    def write_repr(self, out, visited):
+        out.write('Fraction(')
+        RubyVALUE.from_value(self.field('num')).write_repr(out, visited)
+        out.write(', ')
+        RubyVALUE.from_value(self.field('den')).write_repr(out, visited)
+        out.write(')')
+
 class RubyRComplex(RubyRBasic):
     _type = RUBY_T_COMPLEX
     _typename = 'struct RComplex'
 
+    def references(self):
+        return heap_pointers([self.field('real'), self.field('imag')])
+
     def proxyval(self, visited):
-        real = RubyVALUE.proxyval_from_value(self._gdbval['real'], visited)
-        imag = RubyVALUE.proxyval_from_value(self._gdbval['imag'], visited)
+        real = RubyVALUE.proxyval_from_value(self.field('real'), visited)
+        imag = RubyVALUE.proxyval_from_value(self.field('imag'), visited)
         return complex(real, imag)
 
+    def write_repr(self, out, visited):
+        out.checkpoint()
+        parts = [RubyVALUE.proxyval_from_value(self.field(name), visited)
+                 for name in ('real', 'imag')]
+        if all(isinstance(p, (int, long, float)) and not isinstance(p, bool)
+               for p in parts):
+            try:
+                out.write(repr(complex(*parts)))
+                return
+            except OverflowError:
+                pass
+
+        # Anything complex can't hold exactly (e.g. Rational parts) is
+        # written as the Python expression that builds it
+        out.write('complex(')
+        RubyVALUE.from_value(self.field('real')).write_repr(out, visited)
+        out.write(', ')
+        RubyVALUE.from_value(self.field('imag')).write_repr(out, visited)
+        out.write(')')
+
+class RubyRStruct(RubyRBasic):
+    _type = RUBY_T_STRUCT
+    _typename = 'struct RStruct'
+
+    @staticmethod
+    def RSTRUCT_EMBED_LEN_MASK():
+        return FL_USER(2) | FL_USER(1)
+
+    @staticmethod
+    def RSTRUCT_EMBED_LEN_SHIFT():
+        return FL_USHIFT() + 1
+
+    def members(self):
+        """Return the address of the struct's member values"""
+        if self.flags() & self.RSTRUCT_EMBED_LEN_MASK():
+            return self.field_address('as.ary')
+        else:
+            return self.field('as.heap.ptr')
+
+    def length(self):
+        flags = self.flags()
+        if flags & self.RSTRUCT_EMBED_LEN_MASK():
+            return (flags & self.RSTRUCT_EMBED_LEN_MASK()) >> self.RSTRUCT_EMBED_LEN_SHIFT()
+        else:
+            return self.field('as.heap.len')
+
+    def references(self):
+        return heap_pointers(read_words(self.members(), self.length()))
+
 class RubyValPrinter(object):
     def __init__(self, gdbval):
         self.gdbval = gdbval
 
     def to_string(self):
-        return '(Ruby) ' + RubyVALUE.from_value(self.gdbval).get_truncated_repr(MAX_OUTPUT_LEN)
+        try:
+            return '(Ruby) ' + RubyVALUE.from_value(self.gdbval).get_truncated_repr(MAX_OUTPUT_LEN)
+        except RuntimeError:
+            # e.g. we can't tell how this Ruby encodes immediates, so
+            # can't even tell a pointer from a Fixnum
+            return '(Ruby) VALUE 0x%x' % long(self.gdbval)
 
-def pretty_printer_lookup(gdbval):
-    for cls in RubyVALUE.all_subclasses():
-        if cls.get_gdb_type() == gdbval.type.unqualified():
+class RubyContainerPrinter(object):
+    """
+    Printer for Ruby containers that hands their elements to gdb one at
+    a time through children(), so only as many elements as gdb (or an
+    MI frontend) actually displays are ever read
+    """
+    def __init__(self, rval, summary):
+        self.rval = rval
+        self.summary = summary
+
+    def to_string(self):
+        return self.summary
+
+    def children(self):
+        return self.rval.children()
+
+    def display_hint(self):
+        return self.rval.display_hint
+
+# Printing containers element by element changes the output format
+# (e.g. gdb's "{[0] = ..., [1] = ...}" instead of Ruby syntax), so it's
+# opt-in with "set print ruby-children on"
+ruby_children = False
+
+if hasattr(gdb, 'Parameter'):
+    class RubyChildrenParameter(gdb.Parameter):
+        """Print Ruby containers element by element, as gdb children"""
+        set_doc = "Set printing of Ruby containers as gdb children."
+        show_doc = "Show printing of Ruby containers as gdb children."
+
+        def __init__(self):
+            super(RubyChildrenParameter, self).__init__(
+                'print ruby-children', gdb.COMMAND_DATA, gdb.PARAM_BOOLEAN)
+            self.value = ruby_children
+
+        def get_set_string(self):
+            global ruby_children
+            ruby_children = bool(self.value)
+            return ''
+
+        def get_show_string(self, svalue):
+            return 'Printing of Ruby containers as gdb children is %s.' % (svalue,)
+
+    RubyChildrenParameter()
+
+def value_printer(gdbval):
+    if ruby_children:
+        try:
+            rval = RubyVALUE.from_value(gdbval)
+        except RuntimeError:
             return RubyValPrinter(gdbval)
+        if hasattr(rval, 'children'):
+            try:
+                summary = '(Ruby) #<%s>' % rval.class_name()
+            except RuntimeError:
+                # Corrupt object; fall back to the plain repr
+                return RubyValPrinter(gdbval)
+            return RubyContainerPrinter(rval, summary)
+    return RubyValPrinter(gdbval)
+
+def st_table_printer(gdbval):
+    if ruby_children:
+        table = RubySTTable(gdbval)
+        return RubyContainerPrinter(table, '(st_table) 0x%x' % table.as_address())
+
+def type_key(gdbtype):
+    """
+    Key for matching types in printer_dispatch. Typedefs are stripped,
+    the same way gdb.Type equality does.
+    """
+    return str(gdbtype.unqualified().strip_typedefs())
+
+@objfile_cache
+def printer_dispatch():
+    """Map from type_key to printer factory, for every type we print"""
+    dispatch = {}
+    for cls in RubyVALUE.all_subclasses():
+        try:
+            t = cls.get_gdb_type()
+        except RuntimeError:
+            continue
+        if t is not None:
+            dispatch[type_key(t)] = value_printer
+
+    try:
+        dispatch.setdefault(type_key(RubySTTable.get_gdb_type()), st_table_printer)
+    except RuntimeError:
+        pass
+    return dispatch
+
+def pretty_printer_lookup(gdbval):
+    if not ruby_seen:
+        return None
+    printer = printer_dispatch().get(type_key(gdbval.type))
+    if printer is not None:
+        return printer(gdbval)
 
 def register(obj):
     if obj == None:
         obj = gdb
     obj.pretty_printers.append(pretty_printer_lookup)
+
+# Nothing here touches the debug info until an objfile that looks like
+# Ruby has been loaded, so that auto-loading this script costs next to
+# nothing in gdb sessions that never see a Ruby value (and doesn't
+# force symbols to be read early). From then on, everything is looked
+# up lazily and memoized per objfile.
+ruby_seen = False
+
+# The ruby executable, libruby.so, and their separate debug files
+RUBY_OBJFILE_RE = re.compile(r'(^|/)(lib)?ruby[^/]*$')
+
+def is_ruby_objfile(objfile):
+    filename = objfile.filename or ''
+    if RUBY_OBJFILE_RE.search(filename):
+        return True
+    if hasattr(objfile, 'lookup_global_symbol'):
+        # e.g. Ruby statically linked into another program
+        try:
+            return objfile.lookup_global_symbol('ruby_version') is not None
+        except (gdb.error, RuntimeError):
+            return False
+    return False
+
+def check_objfile(objfile):
+    global ruby_seen
+    if not ruby_seen and objfile is not None and is_ruby_objfile(objfile):
+        ruby_seen = True
+
+def forget_objfiles(event=None):
+    global ruby_seen
+    ruby_seen = False
+
+if hasattr(gdb, 'events'):
+    gdb.events.new_objfile.connect(lambda event: check_objfile(event.new_objfile))
+    if hasattr(gdb.events, 'clear_objfiles'):
+        gdb.events.clear_objfiles.connect(forget_objfiles)
+    check_objfile(gdb.current_objfile())
+    for objfile in gdb.objfiles():
+        check_objfile(objfile)
+else:
+    # No way of hearing about new objfiles, so assume the best
+    ruby_seen = True
+
 register(gdb.current_objfile())
+
+# ============
+# Heap walking
+# ============
+
+@objfile_cache
+def classless_types():
+    """Type codes of heap slots whose klass isn't a class (or is garbage)"""
+    classless = set([type_code(RUBY_T_NONE)])
+    for t, name in ruby_value_types().items():
+        if name in ('NODE', 'IMEMO', 'ICLASS', 'ZOMBIE', 'MOVED', 'NONE'):
+            classless.add(t)
+    return classless
+
+@objfile_cache
+def class_types():
+    """Type codes of the objects a klass pointer can point to"""
+    return set(type_code(t) for t in (RUBY_T_CLASS, RUBY_T_MODULE, RUBY_T_ICLASS))
+
+@objfile_cache
+def dead_types():
+    """Type codes of heap slots that don't hold a live object"""
+    dead = set([type_code(RUBY_T_NONE)])
+    for t, name in ruby_value_types().items():
+        if name in ('NONE', 'ZOMBIE', 'MOVED'):
+            dead.add(t)
+    return dead
+
+class RubyHeapPage(object):
+    """
+    A contiguous run of object slots in the Ruby heap, read out of the
+    inferior with a single read
+    """
+    def __init__(self, start, nslots, slot_size):
+        self.start = start
+        self.nslots = nslots
+        self.slot_size = slot_size
+        self.slot_words = slot_size // word_size()
+        self.words = read_words(start, nslots * self.slot_words)
+
+    def objects(self):
+        """
+        Yield (address, flags, klass, base) for each live slot, where
+        base is the index of the slot's first word in self.words
+        """
+        words = self.words
+        step = self.slot_words
+        dead = dead_types()
+        address = self.start
+        for base in xrange(0, len(words), step):
+            flags = words[base]
+            if flags & RUBY_T_MASK not in dead:
+                yield address, flags, words[base + 1], base
+            address += self.slot_size
+
+    def field(self, base, layout, path):
+        """
+        Decode a member (given as a dotted path into layout) of the
+        struct in the slot starting at words[base]
+        """
+        offset, size = layout.fields[path]
+        word = self.words[base + offset // word_size()]
+        shift = offset % word_size()
+        if target_byteorder() == '>':
+            shift = word_size() - shift - size
+        return (word >> (shift * 8)) & ((1 << (size * 8)) - 1)
+
+class RubyHeap(object):
+    """
+    The Ruby object heap, as a sequence of RubyHeapPages
+    """
+    # Ways of finding the rb_objspace_t, in order of Ruby version
+    OBJSPACE_EXPRESSIONS = [
+        'ruby_current_vm_ptr->objspace',
+        'ruby_current_vm->objspace',
+        '&rb_objspace',
+    ]
+
+    def __init__(self):
+        self.objspace = self.find_objspace()
+        try:
+            self.slot_size = gdb.lookup_type('RVALUE').sizeof
+        except (gdb.error, RuntimeError):
+            self.slot_size = 5 * word_size()
+
+    @classmethod
+    @stop_cache
+    def current(cls):
+        return cls()
+
+    def find_objspace(self):
+        for expr in self.OBJSPACE_EXPRESSIONS:
+            try:
+                objspace = gdb.parse_and_eval(expr)
+                if long(objspace):
+                    return objspace
+            except (gdb.error, RuntimeError):
+                continue
+        raise gdb.GdbError("Can't find the Ruby object space")
+
+    @staticmethod
+    def _field_names(v):
+        """Names of the members of the struct v is (or points to)"""
+        t = v.type.strip_typedefs()
+        if t.code == gdb.TYPE_CODE_PTR:
+            t = t.target().strip_typedefs()
+        if t.code not in (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION):
+            return []
+        return [f.name for f in t.fields()]
+
+    def page_bounds(self):
+        """Yield (start, nslots, slot_size) for each heap page"""
+        fields = self._field_names(self.objspace)
+        if 'heap_pages' in fields:
+            # 2.1+: an array of struct heap_page *, sorted by address
+            heap_pages = self.objspace['heap_pages']
+            if 'allocated_pages' in self._field_names(heap_pages):
+                count = long(heap_pages['allocated_pages'])
+            else:
+                count = long(heap_pages['used'])
+
+            pages = heap_pages['sorted']
+            if 'meta' in self._field_names(pages):
+                # 3.3+: sorted is an rb_darray
+                pages = pages['data']
+
+            for i in xrange(count):
+                page = pages[i]
+                names = self._field_names(page)
+                if 'total_slots' in names:
+                    nslots = long(page['total_slots'])
+                else:
+                    nslots = long(page['limit'])
+                if 'slot_size' in names:
+                    slot_size = long(page['slot_size'])
+                else:
+                    slot_size = self.slot_size
+                yield long(page['start']), nslots, slot_size
+        else:
+            # 1.9 and 2.0: an array of (start, end) pairs, sorted by address
+            heap = self.objspace['heap']
+            for i in xrange(long(heap['used'])):
+                slot = heap['sorted'][i]
+                start = long(slot['start'])
+                end = long(slot['end'])
+                yield start, (end - start) // self.slot_size, self.slot_size
+
+    _bounds = None
+
+    def is_slot(self, address):
+        """Whether address is the start of a slot in one of the heap's pages"""
+        if self._bounds is None:
+            self._bounds = sorted(self.page_bounds())
+            self._starts = [start for start, nslots, slot_size in self._bounds]
+        i = bisect.bisect_right(self._starts, address) - 1
+        if i < 0:
+            return False
+        start, nslots, slot_size = self._bounds[i]
+        offset = address - start
+        return offset < nslots * slot_size and not offset % slot_size
+
+    def pages(self):
+        for start, nslots, slot_size in self.page_bounds():
+            try:
+                yield RubyHeapPage(start, nslots, slot_size)
+            except gdb.MemoryError:
+                # Not in the core file (or unmapped); nothing to see
+                continue
+
+    def objects(self):
+        """Yield (page, address, flags, klass, base) for every live object"""
+        for page in self.pages():
+            for address, flags, klass, base in page.objects():
+                yield page, address, flags, klass, base
+
+    @staticmethod
+    def approximate_size(page, base, flags):
+        """
+        Estimate the memory used by the object in a slot: the slot
+        itself plus whatever buffer it points to
+        """
+        size = page.slot_size
+        t = flags & RUBY_T_MASK
+        try:
+            if t == type_code(RUBY_T_STRING) and flags & RubyRString.RSTRING_NOEMBED():
+                # Shared strings don't own their buffer
+                if not flags & FL_USER(2):
+                    size += page.field(base, struct_layout('struct RString'), 'as.heap.aux.capa') + 1
+            elif t == type_code(RUBY_T_ARRAY) and not flags & RubyRArray.RARRAY_EMBED_FLAG():
+                if not flags & FL_USER(2):
+                    size += page.field(base, struct_layout('struct RArray'), 'as.heap.aux.capa') * word_size()
+            elif t == type_code(RUBY_T_OBJECT) and not flags & RubyRObject.ROBJECT_EMBED():
+                size += page.field(base, struct_layout('struct RObject'), 'as.heap.numiv') * word_size()
+        except (AttributeError, KeyError):
+            # No layout for that struct, or a member has moved
+            pass
+        return size
+
+def dump_records(heap):
+    """
+    Generate a record, shaped like the lines of ObjectSpace.dump_all,
+    for every live object in the heap. Records are generated a page at
+    a time, so nothing accumulates as the walk goes on.
+    """
+    class_names = RubyClassNames(heap)
+    try:
+        yield {
+            'type': 'ROOT',
+            'root': 'rb_cObject',
+            'references': ['0x%x' % RubyRClass.cObject().as_address()],
+        }
+    except RuntimeError:
+        pass
+
+    for page, address, flags, klass, base in heap.objects():
+        t = flags & RUBY_T_MASK
+        record = {
+            'address': '0x%x' % address,
+            'type': type_name(t),
+            'memsize': heap.approximate_size(page, base, flags),
+        }
+        if klass and t not in classless_types():
+            record['class'] = '0x%x' % klass
+            name = class_names(klass, t)
+            if name is not None:
+                record['class_name'] = name
+
+        try:
+            rval = RubyVALUE.from_value(address)
+            if isinstance(rval, RubyRBasic):
+                rval.dump_fields(record)
+                references = rval.references()
+                if references:
+                    record['references'] = ['0x%x' % r for r in references]
+        except RuntimeError:
+            # Corrupt or half-initialized object; dump what we have
+            pass
+
+        yield record
+
+class RubyClassNames(object):
+    """
+    Memoized class names for a heap walk, keyed by klass pointer, so
+    each distinct class is only resolved once
+    """
+    def __init__(self, heap=None):
+        self._names = {}
+        self.heap = heap
+
+    def is_class(self, klass):
+        """Whether klass points to a live class, module or iclass slot"""
+        if self.heap is None:
+            self.heap = RubyHeap.current()
+        if not self.heap.is_slot(klass):
+            return False
+        try:
+            flags = read_words(klass, 1)[0]
+        except RuntimeError:
+            return False
+        return flags & RUBY_T_MASK in class_types()
+
+    def __call__(self, klass, t=None):
+        """
+        Return the name of the class klass points to, or None if it's
+        hidden or not a class. t, if given, is the type of the object
+        klass came from; some types use klass for something else.
+        """
+        if t is not None and t in classless_types():
+            return None
+        try:
+            return self._names[klass]
+        except KeyError:
+            pass
+
+        if not klass or not self.is_class(klass):
+            # Hidden object, or not a class at all
+            name = None
+        else:
+            try:
+                rklass = RubyVALUE.from_value(klass)
+                if not isinstance(rklass, RubyRClass):
+                    rklass = RubyRClass(klass)
+                name = rklass.real_class().name()
+            except RuntimeError:
+                name = '<corrupt class 0x%x>' % klass
+        self._names[klass] = name
+        return name
+
+class RubyHeapStatsCommand(gdb.Command):
+    """Print the number and approximate size of live Ruby objects, by type and class.
+
+Usage: ruby-heap-stats [LIMIT]
+
+Only the LIMIT largest rows (by count) are printed; the default is 50."""
+
+    def __init__(self):
+        super(RubyHeapStatsCommand, self).__init__('ruby-heap-stats', gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        limit = int(arg) if arg.strip() else 50
+
+        heap = RubyHeap.current()
+        class_names = RubyClassNames(heap)
+        counts = collections.defaultdict(int)
+        sizes = collections.defaultdict(int)
+        total_count = total_size = 0
+        for page, address, flags, klass, base in heap.objects():
+            key = (flags & RUBY_T_MASK, klass)
+            size = heap.approximate_size(page, base, flags)
+            counts[key] += 1
+            sizes[key] += size
+            total_count += 1
+            total_size += size
+
+        # Merge rows for klass pointers that resolve to the same name
+        # (e.g. singleton classes)
+        rows = collections.defaultdict(lambda: [0, 0])
+        for (t, klass), count in counts.items():
+            row = rows[(type_name(t), class_names(klass, t) or '')]
+            row[0] += count
+            row[1] += sizes[(t, klass)]
+
+        print('%12s %14s  %-8s %s' % ('count', 'bytes', 'type', 'class'))
+        ordered = sorted(rows.items(), key=lambda item: item[1][0], reverse=True)
+        for (tname, cname), (count, size) in ordered[:limit]:
+            print('%12d %14d  %-8s %s' % (count, size, tname, cname))
+        print('%12d %14d  total' % (total_count, total_size))
+
+RubyHeapStatsCommand()
+
+class RubyDumpHeapCommand(gdb.Command):
+    """Write every live Ruby object to FILE, one JSON object per line.
+
+Usage: ruby-dump-heap FILE
+
+The records follow the shape of Ruby's ObjectSpace.dump_all (address,
+type, class, memsize, references, and string/array previews), and are
+written as the heap is walked."""
+
+    def __init__(self):
+        super(RubyDumpHeapCommand, self).__init__('ruby-dump-heap', gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, from_tty):
+        path = arg.strip()
+        if not path:
+            raise gdb.GdbError('Usage: ruby-dump-heap FILE')
+
+        count = 0
+        with open(path, 'w') as f:
+            for record in dump_records(RubyHeap.current()):
+                f.write(json.dumps(record))
+                f.write('\n')
+                count += 1
+        print('Wrote %d records to %s' % (count, path))
+
+RubyDumpHeapCommand()
+
+class RubyReferrerIndex(object):
+    """
+    The reverse of references() over the whole heap: for every live
+    object, the objects that refer to it.
+
+    Objects are numbered in address order, and the referrers of object
+    i are sources[offsets[i]:offsets[i + 1]], so the index stays a
+    handful of flat arrays however big the heap is.
+    """
+    def __init__(self, heap):
+        addresses = array.array(word_typecode())
+        edge_sources = array.array(word_typecode())
+        edge_targets = array.array(word_typecode())
+        for page, address, flags, klass, base in heap.objects():
+            addresses.append(address)
+            try:
+                rval = RubyVALUE.from_value(address)
+                if not isinstance(rval, RubyRBasic):
+                    continue
+                for target in rval.references():
+                    edge_sources.append(address)
+                    edge_targets.append(target)
+            except RuntimeError:
+                # Corrupt or half-initialized object
+                continue
+
+        if any(addresses[i] > addresses[i + 1] for i in xrange(len(addresses) - 1)):
+            addresses = array.array(word_typecode(), sorted(addresses))
+        self.addresses = addresses
+
+        # Bucket the edges by target
+        n = len(addresses)
+        target_indexes = array.array(word_typecode())
+        offsets = array.array(word_typecode(), [0]) * (n + 1)
+        for target in edge_targets:
+            i = self._index(target)
+            target_indexes.append(i if i is not None else n)
+            if i is not None:
+                offsets[i + 1] += 1
+        for i in xrange(n):
+            offsets[i + 1] += offsets[i]
+
+        sources = array.array(word_typecode(), [0]) * offsets[n]
+        fill = array.array(word_typecode(), offsets)
+        for source, i in zip(edge_sources, target_indexes):
+            if i != n:
+                sources[fill[i]] = source
+                fill[i] += 1
+
+        self.offsets = offsets
+        self.sources = sources
+
+    @classmethod
+    @stop_cache
+    def current(cls):
+        return cls(RubyHeap.current())
+
+    def _index(self, address):
+        i = bisect.bisect_left(self.addresses, address)
+        if i < len(self.addresses) and self.addresses[i] == address:
+            return i
+        return None
+
+    def __contains__(self, address):
+        return self._index(address) is not None
+
+    def referrers(self, address):
+        """Return the addresses of the objects that refer to address"""
+        i = self._index(address)
+        if i is None:
+            raise KeyError('0x%x' % address)
+        return self.sources[self.offsets[i]:self.offsets[i + 1]]
+
+    def is_root(self, address):
+        """
+        Whether address is where a path to an object should start:
+        rb_cObject, or an object that nothing in the heap refers to
+        (so it's held from the stack or a C global)
+        """
+        if address == RubyRClass.cObject().as_address():
+            return True
+        i = self._index(address)
+        return i is not None and self.offsets[i] == self.offsets[i + 1]
+
+    def root_path(self, address):
+        """
+        Return the shortest chain of addresses leading from a root to
+        address (inclusive), or None if there isn't one
+        """
+        parents = {address: None}
+        queue = collections.deque([address])
+        while queue:
+            node = queue.popleft()
+            if self.is_root(node):
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+                return path
+            for referrer in self.referrers(node):
+                if referrer not in parents:
+                    parents[referrer] = node
+                    queue.append(referrer)
+        return None
+
+class RubyReferrersCommand(gdb.Command):
+    """Print the heap objects that refer to a Ruby object, and its shortest path from a root.
+
+Usage: ruby-referrers ADDR
+
+Roots are rb_cObject and objects that nothing in the heap refers to
+(i.e. that are held from the stack or C globals). The index of
+references is built the first time this is run at each stop."""
+
+    def __init__(self):
+        super(RubyReferrersCommand, self).__init__('ruby-referrers', gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION)
+
+    @staticmethod
+    def describe(address, class_names):
+        rval = RubyVALUE.from_value(address)
+        try:
+            t = rval.type()
+            return '0x%x %s %s' % (address, type_name(t), class_names(rval.klass(), t) or '')
+        except RuntimeError:
+            return '0x%x <corrupt>' % (address,)
+
+    def invoke(self, arg, from_tty):
+        if not arg.strip():
+            raise gdb.GdbError('Usage: ruby-referrers ADDR')
+        address = long(gdb.parse_and_eval(arg))
+
+        index = RubyReferrerIndex.current()
+        if address not in index:
+            raise gdb.GdbError('0x%x is not a live object in the Ruby heap' % (address,))
+
+        class_names = RubyClassNames()
+        referrers = index.referrers(address)
+        print('%d referrers:' % (len(referrers),))
+        for referrer in referrers:
+            print('  ' + self.describe(referrer, class_names))
+
+        path = index.root_path(address)
+        if path is None:
+            print('No path from a root')
+        else:
+            print('Shortest path from a root:')
+            for node in path:
+                print('  ' + self.describe(node, class_names))
+
+RubyReferrersCommand()
+
+class RubyHeapSnapshot(object):
+    """
+    The addresses and type/class of every live object at one point in
+    time, kept as parallel arrays (sorted by address) so snapshots of
+    big heaps stay small and can outlive the stop, or even the
+    inferior, they were taken in
+    """
+    def __init__(self, heap):
+        class_names = RubyClassNames(heap)
+        self.keys = []
+        key_ids = {}
+        self.addresses = array.array(word_typecode())
+        self.key_ids = array.array('I')
+        for page, address, flags, klass, base in heap.objects():
+            t = flags & RUBY_T_MASK
+            key = (type_name(t), class_names(klass, t) or '')
+            try:
+                key_id = key_ids[key]
+            except KeyError:
+                key_id = key_ids[key] = len(self.keys)
+                self.keys.append(key)
+            self.addresses.append(address)
+            self.key_ids.append(key_id)
+
+        addresses = self.addresses
+        if any(addresses[i] > addresses[i + 1] for i in xrange(len(addresses) - 1)):
+            # Pages normally come out in address order, so this is rare
+            order = sorted(xrange(len(addresses)), key=addresses.__getitem__)
+            self.addresses = array.array(word_typecode(), (addresses[i] for i in order))
+            self.key_ids = array.array('I', (self.key_ids[i] for i in order))
+
+        self.counts = array.array('I', [0]) * len(self.keys)
+        for key_id in self.key_ids:
+            self.counts[key_id] += 1
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def class_counts(self):
+        """Return a map from (type, class name) to number of objects"""
+        return dict(zip(self.keys, self.counts))
+
+    def new_objects(self, before):
+        """
+        Yield (address, (type, class name)) for each object in this
+        snapshot that wasn't in before. An address that has been reused
+        for an object of a different class counts as new.
+        """
+        old = before.addresses
+        i = 0
+        for address, key_id in zip(self.addresses, self.key_ids):
+            while i < len(old) and old[i] < address:
+                i += 1
+            key = self.keys[key_id]
+            if i < len(old) and old[i] == address and before.keys[before.key_ids[i]] == key:
+                continue
+            yield address, key
+
+# Snapshots taken by ruby-heap-snapshot, by name. These deliberately
+# aren't in a cache scope, so they can be compared across stops and
+# core files.
+heap_snapshots = {}
+
+class RubyHeapSnapshotCommand(gdb.Command):
+    """Record the live Ruby objects under NAME, for ruby-heap-diff.
+
+Usage: ruby-heap-snapshot NAME"""
+
+    def __init__(self):
+        super(RubyHeapSnapshotCommand, self).__init__('ruby-heap-snapshot', gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        name = arg.strip()
+        if not name:
+            raise gdb.GdbError('Usage: ruby-heap-snapshot NAME')
+        snapshot = heap_snapshots[name] = RubyHeapSnapshot(RubyHeap.current())
+        print('Snapshot %s: %d objects' % (name, len(snapshot)))
+
+RubyHeapSnapshotCommand()
+
+class RubyHeapDiffCommand(gdb.Command):
+    """Compare two heap snapshots, by class and by object.
+
+Usage: ruby-heap-diff A [B [LIMIT]]
+
+A and B are names given to ruby-heap-snapshot; if B is left out (or is
+"-"), A is compared against the current heap. The LIMIT classes (by
+default 50) with the largest growth are printed, followed by the first
+LIMIT objects in B that weren't in A."""
+
+    def __init__(self):
+        super(RubyHeapDiffCommand, self).__init__('ruby-heap-diff', gdb.COMMAND_DATA)
+
+    @staticmethod
+    def snapshot(name):
+        try:
+            return heap_snapshots[name]
+        except KeyError:
+            raise gdb.GdbError('No heap snapshot named %s' % (name,))
+
+    def invoke(self, arg, from_tty):
+        args = arg.split()
+        if not 1 <= len(args) <= 3:
+            raise gdb.GdbError('Usage: ruby-heap-diff A [B [LIMIT]]')
+        before = self.snapshot(args[0])
+        if len(args) < 2 or args[1] == '-':
+            after = RubyHeapSnapshot(RubyHeap.current())
+        else:
+            after = self.snapshot(args[1])
+        limit = int(args[2]) if len(args) > 2 else 50
+
+        before_counts = before.class_counts()
+        after_counts = after.class_counts()
+        rows = []
+        for key in set(before_counts) | set(after_counts):
+            old = before_counts.get(key, 0)
+            new = after_counts.get(key, 0)
+            if old != new:
+                rows.append((new - old, old, new, key))
+        rows.sort(key=lambda row: row[0], reverse=True)
+
+        print('%12s %12s %12s  %-8s %s' % ('before', 'after', 'delta', 'type', 'class'))
+        for delta, old, new, (tname, cname) in rows[:limit]:
+            print('%12d %12d %+12d  %-8s %s' % (old, new, delta, tname, cname))
+        print('%12d %12d %+12d  total' % (len(before), len(after), len(after) - len(before)))
+
+        count = 0
+        print('')
+        print('New objects:')
+        for address, (tname, cname) in after.new_objects(before):
+            if count < limit:
+                print('  0x%x %s %s' % (address, tname, cname))
+            count += 1
+        if count > limit:
+            print('  ... and %d more' % (count - limit,))
+        print('%d new objects' % (count,))
+
+RubyHeapDiffCommand()
+
+# ===============
+# Ruby backtraces
+# ===============
+#
+# Each Ruby thread keeps a stack of control frames (rb_control_frame_t)
+# at the top of its VM stack, growing down towards the values on it.
+# Frames running Ruby code point to an iseq, whose line table turns
+# the frame's pc into a line number. Frames running C functions carry
+# their method entry instead.
+
+class RubyISeqInfo(object):
+    """
+    The path, label and line table of an iseq: everything needed to
+    describe a frame running it. Iseqs don't change once compiled, so
+    these are cached per inferior (see iseq_info).
+    """
+    # Line numbers of the first IMMEDIATE_TABLE_SIZE instructions are
+    # kept separately in a succinct line table (see succ_index_lookup)
+    IMMEDIATE_TABLE_SIZE = 54
+    SUCC_BLOCK_BITS = 512
+
+    def __init__(self, iseq):
+        raw = RubyRawStruct(struct_layout('rb_iseq_t'), iseq)
+        if 'body' in raw:
+            # 2.3+ splits the iseq into a header and a constant body
+            body = RubyRawStruct(struct_layout('struct rb_iseq_constant_body'), raw['body'])
+        else:
+            body = raw
+
+        self.label = self.string(body['location.label'])
+        self.path = '<unknown>'
+        for path in ('location.pathobj', 'location.path'):
+            if path in body:
+                self.path = self.string(body[path])
+                break
+
+        self.first_lineno = body['location.first_lineno']
+        if body.layout.size('location.first_lineno') == word_size():
+            # A Fixnum before 2.6
+            self.first_lineno = fixnum_value(self.first_lineno)
+
+        self.iseq_encoded = body['iseq_encoded']
+        self.positions = None
+        self.succ_index_table = None
+        self.lines = []
+        self._read_line_table(body)
+
+    @staticmethod
+    def string(v):
+        """Decode a path or label, which may be a [path, realpath] pair"""
+        rval = RubyVALUE.from_value(v)
+        if isinstance(rval, RubyRArray):
+            rval = RubyVALUE.from_value(rval[0])
+        return str(rval)
+
+    def _read_line_table(self, body):
+        if 'insns_info.body' in body:
+            # 2.6+: line numbers, with positions either alongside or
+            # encoded into a succinct bit vector
+            entries = body['insns_info.body']
+            size = body['insns_info.size']
+            entry = struct_layout('struct iseq_insn_info_entry')
+        elif 'insns_info_size' in body:
+            # 2.5
+            entries = body['insns_info']
+            size = body['insns_info_size']
+            entry = struct_layout('struct iseq_insn_info_entry')
+        else:
+            entries = body['line_info_table']
+            size = body['line_info_size']
+            entry = struct_layout('struct iseq_line_info_entry')
+        if not entries or not size or entry is None:
+            return
+
+        data = read_memory(entries, size * entry.sizeof)
+        self.lines = self.unpack_column(data, entry, 'line_no')
+        if 'position' in entry:
+            self.positions = self.unpack_column(data, entry, 'position')
+        elif 'insns_info.positions' in body and body['insns_info.positions']:
+            positions = read_memory(body['insns_info.positions'], size * 4)
+            self.positions = list(struct.unpack(target_byteorder() + 'I' * size, positions))
+        elif 'insns_info.succ_index_table' in body:
+            self.succ_index_table = body['insns_info.succ_index_table']
+
+    @staticmethod
+    def unpack_column(data, layout, path):
+        """Decode one member of each of an array of structs"""
+        offset, size = layout.fields[path]
+        fmt = target_byteorder() + _int_formats[size]
+        return [struct.unpack_from(fmt, data, base + offset)[0]
+                for base in xrange(0, len(data), layout.sizeof)]
+
+    def succ_index_lookup(self, x):
+        """
+        Return how many instructions up to and including position x
+        start a new line table entry, from the succinct bit vector
+        (iseq.c's succ_index_lookup)
+        """
+        table = struct_layout('struct succ_index_table')
+        fmt = target_byteorder() + 'Q'
+        if x < self.IMMEDIATE_TABLE_SIZE:
+            word = struct.unpack(fmt, read_memory(
+                self.succ_index_table + table.offset('imm_part') + (x // 9) * 8, 8))[0]
+            return (word >> ((x % 9) * 7)) & 0x7f
+
+        block = struct_layout('struct succ_dict_block')
+        x -= self.IMMEDIATE_TABLE_SIZE
+        address = self.succ_index_table + table.offset('succ_part') + (x // self.SUCC_BLOCK_BITS) * block.sizeof
+        raw = RubyRawStruct(block, address)
+        bit = x % self.SUCC_BLOCK_BITS
+        small_block = bit // 64
+        small_rank = 0
+        if small_block:
+            small_rank = (raw['small_block_ranks'] >> ((small_block - 1) * 9)) & 0x1ff
+        bits = struct.unpack_from(fmt, raw.data, block.offset('bits') + small_block * 8)[0]
+        bits = (bits << (63 - bit % 64)) & 0xffffffffffffffff
+        return raw['rank'] + small_rank + bin(bits).count('1')
+
+    def line(self, pc):
+        """Return the line number being run when the frame's pc is pc"""
+        if not self.lines:
+            return self.first_lineno
+
+        # pc has already moved on to the next instruction
+        pos = (pc - self.iseq_encoded) // word_size()
+        if pos:
+            pos -= 1
+
+        if len(self.lines) == 1:
+            return self.lines[0]
+        if self.positions is not None:
+            return self.lines[max(0, bisect.bisect_right(self.positions, pos) - 1)]
+        if self.succ_index_table:
+            index = self.succ_index_lookup(pos)
+            return self.lines[max(0, min(index, len(self.lines)) - 1)]
+        return self.first_lineno
+
+# Bounded because long-running processes can compile a lot of iseqs
+MAX_CACHED_ISEQS = 10000
+
+@inferior_cache(maxsize=MAX_CACHED_ISEQS)
+def iseq_info(iseq, body):
+    """
+    Return the RubyISeqInfo for the iseq at address iseq. body is the
+    address of its constant body (or 0), so that a freed iseq whose
+    address gets reused isn't mistaken for the old one.
+    """
+    return RubyISeqInfo(iseq)
+
+@objfile_cache
+def iseq_has_body():
+    return 'body' in struct_layout('rb_iseq_t')
+
+@inferior_cache(maxsize=MAX_CACHED_ISEQS)
+def method_name(id):
+    """The name of a method, by ID; IDs are never reused"""
+    return str(RubyID(id))
+
+class RubyFrame(object):
+    """One frame of a Ruby backtrace"""
+    def __init__(self, cfp, label, path=None, lineno=None, cfunc=False):
+        self.cfp = cfp
+        self.label = label
+        self.path = path
+        self.lineno = lineno
+        self.cfunc = cfunc
+
+    def __str__(self):
+        if self.path is None:
+            return "in `%s'" % (self.label,)
+        return "%s:%d:in `%s'" % (self.path, self.lineno, self.label)
+
+@objfile_cache
+def frame_magic():
+    """
+    Return (VM_FRAME_MAGIC_CFUNC, VM_FRAME_MAGIC_MASK), from the debug
+    info if possible
+    """
+    try:
+        return (long(gdb.parse_and_eval('VM_FRAME_MAGIC_CFUNC')),
+                long(gdb.parse_and_eval('VM_FRAME_MAGIC_MASK')))
+    except (gdb.error, RuntimeError):
+        pass
+    if 'flag' in struct_layout('rb_control_frame_t'):
+        # Before 2.5, frames had their own flags
+        return 0x61, 0xff
+    return 0x55550001, 0x7fff0001
+
+def frame_flags(cfp):
+    if 'flag' in cfp:
+        return cfp['flag']
+    # 2.5+ keeps them in the environment, at ep[VM_ENV_DATA_INDEX_FLAGS]
+    return read_words(cfp['ep'], 1)[0]
+
+def cfunc_name(cfp):
+    if 'me' in cfp:
+        me = cfp['me']
+    else:
+        # 2.3+: at ep[VM_ENV_DATA_INDEX_ME_CREF]
+        me = read_words(cfp['ep'] - 2 * word_size(), 1)[0]
+    layout = struct_layout('struct rb_method_entry_struct')
+    return method_name(RubyRawStruct(layout, me)['called_id'])
+
+def decode_control_frame(cfp):
+    """
+    Return the RubyFrame for the control frame cfp (a RubyRawStruct of
+    an rb_control_frame_t), or None if it's one of the VM's internal
+    frames. C function frames get no path or line number.
+    """
+    iseq = cfp['iseq']
+    pc = cfp['pc']
+    if iseq and pc:
+        body = read_words(iseq + struct_layout('rb_iseq_t').offset('body'), 1)[0] if iseq_has_body() else 0
+        info = iseq_info(iseq, body)
+        return RubyFrame(cfp.address, info.label, info.path, info.line(pc))
+
+    cfunc, mask = frame_magic()
+    if frame_flags(cfp) & mask == cfunc:
+        return RubyFrame(cfp.address, cfunc_name(cfp), cfunc=True)
+    return None
+
+class RubyExecutionContext(object):
+    """
+    Where a Ruby thread keeps its control frames: an
+    rb_execution_context_t (2.5+) or an rb_thread_t
+    """
+    # Ways of finding the current thread's, in order of Ruby version
+    CURRENT_EXPRESSIONS = [
+        ('ruby_current_ec', 'rb_execution_context_t'),
+        ('ruby_current_execution_context_ptr', 'rb_execution_context_t'),
+        ('ruby_current_vm_ptr->ractor.main_thread->ec', 'rb_execution_context_t'),
+        ('ruby_current_thread', 'rb_thread_t'),
+    ]
+
+    def __init__(self, address, typename):
+        raw = RubyRawStruct(struct_layout(typename), address)
+        self.cfp = raw['cfp']
+        if 'vm_stack' in raw:
+            self.end = raw['vm_stack'] + raw['vm_stack_size'] * word_size()
+        else:
+            self.end = raw['stack'] + raw['stack_size'] * word_size()
+
+    @classmethod
+    def current(cls):
+        for expr, typename in cls.CURRENT_EXPRESSIONS:
+            try:
+                address = long(gdb.parse_and_eval(expr))
+            except (gdb.error, RuntimeError):
+                continue
+            if address:
+                return cls(address, typename)
+        raise gdb.GdbError("Can't find the current Ruby thread")
+
+    @classmethod
+    def of_thread(cls, th):
+        """Return the execution context of the rb_thread_t at th"""
+        layout = struct_layout('rb_thread_t')
+        if 'ec.cfp' in layout:
+            # 2.5 embeds it
+            return cls(th + layout.offset('ec'), 'rb_execution_context_t')
+        elif 'ec' in layout:
+            return cls(RubyRawStruct(layout, th)['ec'], 'rb_execution_context_t')
+        return cls(th, 'rb_thread_t')
+
+    def control_frames(self):
+        """Yield a RubyRawStruct for each control frame, innermost first"""
+        layout = struct_layout('rb_control_frame_t')
+        if not self.cfp or self.end <= self.cfp:
+            return
+        data = read_memory(self.cfp, self.end - self.cfp)
+        for offset in xrange(0, len(data) - layout.sizeof + 1, layout.sizeof):
+            yield RubyRawStruct(layout, self.cfp + offset,
+                                data[offset:offset + layout.sizeof])
+
+    def frames(self):
+        """
+        Return the RubyFrames of the thread's backtrace, innermost
+        first. Like Ruby, C functions are reported at the location of
+        the Ruby code that called them.
+        """
+        frames = []
+        for cfp in self.control_frames():
+            try:
+                frame = decode_control_frame(cfp)
+            except (RuntimeError, KeyError, AttributeError, struct.error):
+                # Half-built or corrupt frame
+                frame = RubyFrame(cfp.address, '<unknown>')
+            if frame is not None:
+                frames.append(frame)
+
+        caller = None
+        for frame in reversed(frames):
+            if frame.path is not None:
+                caller = frame
+            elif frame.cfunc and caller is not None:
+                frame.path = caller.path
+                frame.lineno = caller.lineno
+        return frames
+
+def living_threads():
+    """Yield the address of every live thread's rb_thread_t"""
+    vm = None
+    for expr in ('ruby_current_vm_ptr', 'ruby_current_vm'):
+        try:
+            vm = gdb.parse_and_eval(expr)
+            break
+        except (gdb.error, RuntimeError):
+            continue
+    if vm is None or not long(vm):
+        raise gdb.GdbError("Can't find the Ruby VM")
+
+    thread = struct_layout('rb_thread_t')
+    if 'lt_node' in thread:
+        # 3.0+: a list per ractor; we only look at the main one
+        head = vm['ractor']['main_ractor']['threads']['set']
+        node_offset = thread.offset('lt_node')
+    else:
+        head = vm['living_threads']
+        if head.type.strip_typedefs().code == gdb.TYPE_CODE_PTR:
+            # 1.9 to 2.1: an st_table whose keys are Thread objects
+            data = struct_layout('struct RTypedData') or struct_layout('struct RData')
+            for k, _ in RubySTTable(long(head)).items():
+                yield RubyRawStruct(data, k)['data']
+            return
+        node_offset = thread.offset('vmlt_node')
+
+    # A ccan list: circular, through a member of each rb_thread_t
+    end = long(head['n'].address)
+    node = long(head['n']['next'])
+    while node and node != end:
+        yield node - node_offset
+        node = read_words(node, 1)[0]
+
+class RubyBacktraceCommand(gdb.Command):
+    """Print the Ruby backtrace of the current Ruby thread, or of all of them.
+
+Usage: ruby-bt [all-threads]"""
+
+    def __init__(self):
+        super(RubyBacktraceCommand, self).__init__('ruby-bt', gdb.COMMAND_STACK)
+
+    @staticmethod
+    def print_frames(ec):
+        for i, frame in enumerate(ec.frames()):
+            print('#%-3d %s' % (i, frame))
+
+    def invoke(self, arg, from_tty):
+        arg = arg.strip()
+        if arg == 'all-threads':
+            for th in living_threads():
+                print('Thread 0x%x:' % (th,))
+                self.print_frames(RubyExecutionContext.of_thread(th))
+                print('')
+        elif not arg:
+            self.print_frames(RubyExecutionContext.current())
+        else:
+            raise gdb.GdbError('Usage: ruby-bt [all-threads]')
+
+RubyBacktraceCommand()
+
+# =======================
+# Ruby frames in gdb's bt
+# =======================
+#
+# The VM's own C functions keep the control frame they're running in
+# reg_cfp (or cfp), so bt can say which Ruby code each of them was
+# running. Frame filters need gdb 7.7 or later.
+
+try:
+    from gdb.FrameDecorator import FrameDecorator
+except ImportError:
+    FrameDecorator = None
+
+# vm_exec_core, vm_call_cfunc, rb_vm_invoke_proc, ...
+VM_FUNCTION_RE = re.compile(r'^(rb_)?vm_')
+
+@stop_cache
+def control_frame_at(cfp):
+    """Return the RubyFrame for the control frame at address cfp, or None"""
+    layout = struct_layout('rb_control_frame_t')
+    if layout is None or not cfp:
+        return None
+    return decode_control_frame(RubyRawStruct(layout, cfp))
+
+def frame_cfp(frame):
+    """Return the control frame a VM function's gdb.Frame is running, or 0"""
+    for name in ('reg_cfp', 'cfp'):
+        try:
+            return long(frame.read_var(name))
+        except (ValueError, gdb.error, RuntimeError):
+            continue
+    return 0
+
+if FrameDecorator is not None:
+    class RubyFrameDecorator(FrameDecorator):
+        """
+        Appends the Ruby frame to the names of VM functions. Nothing is
+        decoded until gdb asks for the name, i.e. only for frames that
+        are actually printed.
+        """
+        def function(self):
+            name = self._base.function()
+            if not isinstance(name, str) or not VM_FUNCTION_RE.match(name):
+                return name
+            try:
+                frame = control_frame_at(frame_cfp(self._base.inferior_frame()))
+            except (gdb.error, RuntimeError, KeyError, struct.error):
+                frame = None
+            if frame is None:
+                return name
+            return '%s [%s]' % (name, frame)
+
+    class RubyFrameFilter(object):
+        def __init__(self):
+            self.name = 'rugdby'
+            self.priority = 100
+            self.enabled = True
+
+        def filter(self, frame_iter):
+            if not ruby_seen:
+                return frame_iter
+            # A generator, so that bt N only decorates N frames
+            return (RubyFrameDecorator(f) for f in frame_iter)
+
+    if hasattr(gdb, 'frame_filters'):
+        gdb.frame_filters['rugdby'] = RubyFrameFilter()
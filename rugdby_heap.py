@@ -0,0 +1,579 @@
+#!/usr/bin/python
+"""
+Offline analysis of rugdby heap dumps
+
+rugdby's ruby-dump-heap command writes every live object in a Ruby
+process to a file of JSON lines, in the same shape as Ruby's own
+ObjectSpace.dump_all. This module loads such a dump (either kind)
+without needing gdb, and answers questions like "which classes use the
+most memory?" and "what is keeping this object alive?".
+
+Dumps of production heaps run to tens of millions of objects, so
+nothing here keeps a Python object per Ruby object. Instead, objects
+are numbered in address order and their attributes are stored in
+parallel arrays (the HeapDump columns), with references stored as a
+compressed adjacency list. Parsing and aggregation are split across a
+process pool.
+
+This file needs to work with both Python 2 and 3, like rugdby.py.
+"""
+
+from __future__ import print_function, with_statement
+import array
+import bisect
+import collections
+import heapq
+import json
+import multiprocessing
+import os
+import sys
+
+if sys.version_info[0] >= 3:
+    xrange = range
+
+# Index used for "no such object"
+NONE = 0xffffffff
+
+# The most of the dump one worker parses (and sorts) at once
+MAX_CHUNK_BYTES = 64 << 20
+
+def _typecode(itemsize):
+    for typecode in 'ILQ':
+        try:
+            if array.array(typecode).itemsize == itemsize:
+                return typecode
+        except ValueError:
+            # 'Q' is only available from Python 3.3
+            pass
+    raise RuntimeError("No array typecode for %d-byte items" % itemsize)
+
+# Addresses and sizes, and object indexes
+ADDRESS = _typecode(8)
+INDEX = _typecode(4)
+
+# ==========================
+# Process pool orchestration
+# ==========================
+#
+# Workers need read access to large arrays (e.g. every object's
+# address). Where the pool forks, workers simply inherit them from
+# this global; otherwise they're shipped once to each worker.
+
+_shared = {}
+
+def _set_shared(shared):
+    global _shared
+    _shared = shared
+
+def _fork_shares_memory():
+    try:
+        return multiprocessing.get_start_method() == 'fork'
+    except AttributeError:
+        return sys.platform != 'win32'
+
+def _map(func, tasks, processes, shared=None):
+    """map(func, tasks), over a pool of processes if there's more than one"""
+    _set_shared(shared or {})
+    if processes == 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+
+    if _fork_shares_memory():
+        pool = multiprocessing.Pool(processes)
+    else:
+        pool = multiprocessing.Pool(processes, _set_shared, (_shared,))
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def _ranges(n, parts):
+    """Split range(n) into at most parts contiguous (start, stop) ranges"""
+    step = max(1, -(-n // max(1, parts)))
+    return [(start, min(n, start + step)) for start in xrange(0, n, step)]
+
+# =======
+# Parsing
+# =======
+
+def _address(s):
+    return int(s, 16)
+
+class _Chunk(object):
+    """The columns parsed out of one byte range of a dump"""
+    def __init__(self):
+        self.addresses = array.array(ADDRESS)
+        self.types = array.array(INDEX)
+        self.classes = array.array(INDEX)
+        self.memsizes = array.array(ADDRESS)
+        self.ref_counts = array.array(INDEX)
+        self.refs = array.array(ADDRESS)
+        self.roots = array.array(ADDRESS)
+        # Index of each object in address order, if it isn't already
+        self.order = None
+        # Strings interned per chunk, remapped when chunks are merged
+        self.type_names = []
+        self.class_names = []
+
+def _intern(names, table, name):
+    try:
+        return table[name]
+    except KeyError:
+        table[name] = len(names)
+        names.append(name)
+        return table[name]
+
+def _parse_chunk(task):
+    path, start, stop = task
+    chunk = _Chunk()
+    type_table = {}
+    class_table = {}
+
+    with open(path, 'rb') as f:
+        if start:
+            # Skip the line straddling the start of the range; the
+            # previous chunk owns it
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < stop:
+            line = f.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+
+            record = json.loads(line.decode('utf-8'))
+            refs = record.get('references', ())
+            if record.get('type') == 'ROOT':
+                chunk.roots.extend(_address(r) for r in refs)
+                continue
+            if 'address' not in record:
+                continue
+
+            chunk.addresses.append(_address(record['address']))
+            chunk.types.append(_intern(chunk.type_names, type_table, record.get('type', '')))
+            name = record.get('class_name') or record.get('class') or ''
+            chunk.classes.append(_intern(chunk.class_names, class_table, name))
+            chunk.memsizes.append(record.get('memsize', 0))
+            chunk.ref_counts.append(len(refs))
+            chunk.refs.extend(_address(r) for r in refs)
+
+    # Chunks are at most MAX_CHUNK_BYTES of the dump, which bounds the
+    # temporary list sorting one takes
+    addresses = chunk.addresses
+    if any(addresses[i] > addresses[i + 1] for i in xrange(len(addresses) - 1)):
+        chunk.order = array.array(INDEX, sorted(xrange(len(addresses)), key=addresses.__getitem__))
+    return chunk
+
+def _resolve_refs(task):
+    """
+    Translate the referenced addresses of objects [start, stop) into
+    object indexes, dropping references to objects not in the dump
+    """
+    start, stop = task
+    addresses = _shared['addresses']
+    ref_offsets = _shared['ref_offsets']
+    refs = _shared['refs']
+    n = len(addresses)
+
+    counts = array.array(INDEX)
+    targets = array.array(INDEX)
+    for i in xrange(start, stop):
+        count = 0
+        for j in xrange(ref_offsets[i], ref_offsets[i + 1]):
+            k = bisect.bisect_left(addresses, refs[j])
+            if k < n and addresses[k] == refs[j]:
+                targets.append(k)
+                count += 1
+        counts.append(count)
+    return counts, targets
+
+def _class_totals(task):
+    start, stop = task
+    classes = _shared['classes']
+    types = _shared['types']
+    memsizes = _shared['memsizes']
+    counts = collections.defaultdict(int)
+    sizes = collections.defaultdict(int)
+    for i in xrange(start, stop):
+        key = (types[i], classes[i])
+        counts[key] += 1
+        sizes[key] += memsizes[i]
+    return dict(counts), dict(sizes)
+
+# ========
+# The dump
+# ========
+
+class HeapDump(object):
+    """
+    A loaded heap dump. Object i has address addresses[i] (which are
+    in increasing order), type type_names[types[i]], class
+    class_names[classes[i]] and size memsizes[i]. It refers to objects
+    edge_targets[edge_offsets[i]:edge_offsets[i + 1]].
+    """
+    def __init__(self, addresses, types, type_names, classes, class_names,
+                 memsizes, edge_offsets, edge_targets, roots):
+        self.addresses = addresses
+        self.types = types
+        self.type_names = type_names
+        self.classes = classes
+        self.class_names = class_names
+        self.memsizes = memsizes
+        self.edge_offsets = edge_offsets
+        self.edge_targets = edge_targets
+        self.roots = roots
+
+        self._order = None
+        self._idom = None
+        self._retained = None
+
+    @classmethod
+    def load(cls, path, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        size = os.path.getsize(path)
+        parts = max(processes * 4, size // MAX_CHUNK_BYTES + 1)
+        tasks = [(path, start, stop) for start, stop in _ranges(size, parts)]
+        chunks = _map(_parse_chunk, tasks, processes)
+
+        # Merge the chunks, re-interning their strings
+        type_names, type_table = [], {}
+        class_names, class_table = [], {}
+        addresses = array.array(ADDRESS)
+        types = array.array(INDEX)
+        classes = array.array(INDEX)
+        memsizes = array.array(ADDRESS)
+        ref_counts = array.array(INDEX)
+        refs = array.array(ADDRESS)
+        root_addresses = array.array(ADDRESS)
+        # (first index, count, order) of each chunk's objects
+        runs = []
+        for chunk in chunks:
+            runs.append((len(addresses), len(chunk.addresses), chunk.order))
+            type_map = [_intern(type_names, type_table, name) for name in chunk.type_names]
+            class_map = [_intern(class_names, class_table, name) for name in chunk.class_names]
+            addresses.extend(chunk.addresses)
+            types.extend(type_map[t] for t in chunk.types)
+            classes.extend(class_map[c] for c in chunk.classes)
+            memsizes.extend(chunk.memsizes)
+            ref_counts.extend(chunk.ref_counts)
+            refs.extend(chunk.refs)
+            root_addresses.extend(chunk.roots)
+        del chunks
+
+        ref_offsets = array.array(ADDRESS, [0])
+        total = 0
+        for count in ref_counts:
+            total += count
+            ref_offsets.append(total)
+
+        if any(addresses[i] > addresses[i + 1] for i in xrange(len(addresses) - 1)):
+            # rugdby writes objects in address order, but other dumpers
+            # (e.g. dump_all) don't
+            order = cls._merge_order(addresses, runs)
+            addresses, types, classes, memsizes, ref_offsets, refs = cls._sort(
+                addresses, types, classes, memsizes, ref_offsets, refs, order)
+        del runs
+
+        shared = {'addresses': addresses, 'ref_offsets': ref_offsets, 'refs': refs}
+        resolved = _map(_resolve_refs, _ranges(len(addresses), processes * 4), processes, shared)
+        del ref_offsets, refs
+
+        edge_offsets = array.array(ADDRESS, [0])
+        edge_targets = array.array(INDEX)
+        total = 0
+        for counts, targets in resolved:
+            for count in counts:
+                total += count
+                edge_offsets.append(total)
+            edge_targets.extend(targets)
+        del resolved
+
+        roots = array.array(INDEX)
+        for address in root_addresses:
+            k = bisect.bisect_left(addresses, address)
+            if k < len(addresses) and addresses[k] == address:
+                roots.append(k)
+
+        return cls(addresses, types, type_names, classes, class_names,
+                   memsizes, edge_offsets, edge_targets, roots)
+
+    @staticmethod
+    def _merge_order(addresses, runs):
+        """
+        Return the permutation putting objects in address order, as an
+        array of indexes, by merging the chunks' own (sorted) orders
+        """
+        def run(base, count, order):
+            if order is None:
+                indexes = xrange(base, base + count)
+            else:
+                indexes = (base + j for j in order)
+            for i in indexes:
+                yield addresses[i], i
+
+        order = array.array(INDEX)
+        order.extend(i for _, i in heapq.merge(*[run(*r) for r in runs]))
+        return order
+
+    @staticmethod
+    def _sort(addresses, types, classes, memsizes, ref_offsets, refs, order):
+        """Permute the columns into the given order"""
+        new_refs = array.array(ADDRESS)
+        new_offsets = array.array(ADDRESS, [0])
+        for i in order:
+            new_refs.extend(refs[ref_offsets[i]:ref_offsets[i + 1]])
+            new_offsets.append(len(new_refs))
+        return (array.array(ADDRESS, (addresses[i] for i in order)),
+                array.array(INDEX, (types[i] for i in order)),
+                array.array(INDEX, (classes[i] for i in order)),
+                array.array(ADDRESS, (memsizes[i] for i in order)),
+                new_offsets, new_refs)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def index(self, address):
+        """Return the index of the object at address"""
+        k = bisect.bisect_left(self.addresses, address)
+        if k < len(self.addresses) and self.addresses[k] == address:
+            return k
+        raise KeyError('0x%x' % address)
+
+    def type_name(self, i):
+        return self.type_names[self.types[i]]
+
+    def class_name(self, i):
+        return self.class_names[self.classes[i]]
+
+    def references(self, i):
+        return self.edge_targets[self.edge_offsets[i]:self.edge_offsets[i + 1]]
+
+    def by_class(self, processes=None):
+        """
+        Return (type, class, count, memsize) for every type and class
+        of object in the dump, largest total memsize first
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        shared = {'classes': self.classes, 'types': self.types, 'memsizes': self.memsizes}
+        counts = collections.defaultdict(int)
+        sizes = collections.defaultdict(int)
+        for part_counts, part_sizes in _map(_class_totals, _ranges(len(self), processes), processes, shared):
+            for key, count in part_counts.items():
+                counts[key] += count
+                sizes[key] += part_sizes[key]
+
+        rows = [(self.type_names[t], self.class_names[c], counts[(t, c)], sizes[(t, c)])
+                for t, c in counts]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows
+
+    # Dominators
+    #
+    # Object d dominates object o if every path from the roots to o
+    # goes through d, so freeing d would free o too. The dominators
+    # are computed over the graph with an extra, virtual root (index
+    # len(self)) pointing at the dump's roots, using the iterative
+    # algorithm from Cooper, Harvey and Kennedy's "A Simple, Fast
+    # Dominance Algorithm".
+
+    def _root_order(self):
+        """
+        Return the objects in reverse postorder from the virtual root.
+        Objects nobody refers to count as roots, as does anything left
+        unreachable after that (i.e. garbage cycles).
+        """
+        n = len(self)
+        has_referrers = array.array('b', [0]) * n
+        for target in self.edge_targets:
+            has_referrers[target] = 1
+        roots = array.array(INDEX, self.roots)
+        roots.extend(i for i in xrange(n) if not has_referrers[i])
+        del has_referrers
+
+        visited = array.array('b', [0]) * n
+        postorder = array.array(INDEX)
+        offsets, targets = self.edge_offsets, self.edge_targets
+
+        # The DFS stack, as parallel arrays of nodes and the next edge
+        # to follow from each, since it can get as deep as the heap
+        stack_nodes = array.array(INDEX)
+        stack_edges = array.array(ADDRESS)
+
+        def walk(root):
+            visited[root] = 1
+            stack_nodes.append(root)
+            stack_edges.append(offsets[root])
+            while stack_nodes:
+                node = stack_nodes[-1]
+                edge = stack_edges[-1]
+                if edge < offsets[node + 1]:
+                    stack_edges[-1] = edge + 1
+                    child = targets[edge]
+                    if not visited[child]:
+                        visited[child] = 1
+                        stack_nodes.append(child)
+                        stack_edges.append(offsets[child])
+                else:
+                    stack_nodes.pop()
+                    stack_edges.pop()
+                    postorder.append(node)
+
+        for root in roots:
+            if not visited[root]:
+                walk(root)
+        for i in xrange(n):
+            if not visited[i]:
+                roots.append(i)
+                walk(i)
+
+        postorder.reverse()
+        return postorder, roots
+
+    def _predecessors(self):
+        """Reverse adjacency list, in the same compressed format"""
+        n = len(self)
+        counts = array.array(ADDRESS, [0]) * (n + 1)
+        for target in self.edge_targets:
+            counts[target + 1] += 1
+        for i in xrange(n):
+            counts[i + 1] += counts[i]
+
+        sources = array.array(INDEX, [0]) * len(self.edge_targets)
+        fill = array.array(ADDRESS, counts)
+        for source in xrange(n):
+            for edge in xrange(self.edge_offsets[source], self.edge_offsets[source + 1]):
+                target = self.edge_targets[edge]
+                sources[fill[target]] = source
+                fill[target] += 1
+        return counts, sources
+
+    def dominators(self):
+        """
+        Return the immediate dominator of every object, as an array of
+        indexes; len(self) means the object is only dominated by the
+        virtual root
+        """
+        if self._idom is not None:
+            return self._idom
+
+        n = len(self)
+        order, roots = self._root_order()
+        # Position of each object in reverse postorder; the virtual
+        # root comes first
+        rpo = array.array(INDEX, [NONE]) * (n + 1)
+        rpo[n] = 0
+        for position, node in enumerate(order):
+            rpo[node] = position + 1
+
+        is_root = array.array('b', [0]) * n
+        for root in roots:
+            is_root[root] = 1
+
+        pred_offsets, pred_sources = self._predecessors()
+        idom = array.array(INDEX, [NONE]) * (n + 1)
+        idom[n] = n
+
+        def intersect(a, b):
+            while a != b:
+                while rpo[a] > rpo[b]:
+                    a = idom[a]
+                while rpo[b] > rpo[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for node in order:
+                new_idom = n if is_root[node] else NONE
+                for edge in xrange(pred_offsets[node], pred_offsets[node + 1]):
+                    pred = pred_sources[edge]
+                    if idom[pred] == NONE:
+                        continue
+                    new_idom = pred if new_idom == NONE else intersect(pred, new_idom)
+                if new_idom != idom[node]:
+                    idom[node] = new_idom
+                    changed = True
+
+        self._order = order
+        self._idom = idom
+        return idom
+
+    def retained_sizes(self):
+        """
+        Return the retained size of every object: its own memsize plus
+        that of every object it dominates
+        """
+        if self._retained is not None:
+            return self._retained
+
+        idom = self.dominators()
+        retained = array.array(ADDRESS, self.memsizes)
+        retained.append(0)
+        # Every object comes after its dominator in reverse postorder
+        for node in reversed(self._order):
+            retained[idom[node]] += retained[node]
+        self._retained = retained
+        return retained
+
+    def retained_size(self, address):
+        return self.retained_sizes()[self.index(address)]
+
+    def dominator_chain(self, address):
+        """Return the addresses of the dominators of the object at address, nearest first"""
+        idom = self.dominators()
+        chain = []
+        node = idom[self.index(address)]
+        while node != len(self):
+            chain.append(self.addresses[node])
+            node = idom[node]
+        return chain
+
+    def top_retainers(self, count):
+        """Return the indexes of the count objects with the largest retained size"""
+        retained = self.retained_sizes()
+        return heapq.nlargest(count, xrange(len(self)), key=retained.__getitem__)
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Analyze a heap dump written by ruby-dump-heap')
+    parser.add_argument('dump')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--top', type=int, default=20,
+                        help='how many rows to print (default: 20)')
+    parser.add_argument('--retainers', action='store_true',
+                        help='print the objects with the largest retained size')
+    parser.add_argument('--object', metavar='ADDRESS',
+                        help='print the retained size and dominators of one object')
+    args = parser.parse_args(argv)
+
+    dump = HeapDump.load(args.dump, args.processes)
+    if args.object:
+        address = int(args.object, 16)
+        i = dump.index(address)
+        print('0x%x %s %s: retains %d bytes' % (address, dump.type_name(i), dump.class_name(i),
+                                               dump.retained_size(address)))
+        for dominator in dump.dominator_chain(address):
+            j = dump.index(dominator)
+            print('  dominated by 0x%x %s %s' % (dominator, dump.type_name(j), dump.class_name(j)))
+    elif args.retainers:
+        retained = dump.retained_sizes()
+        print('%14s %-18s %-8s %s' % ('retained', 'address', 'type', 'class'))
+        for i in dump.top_retainers(args.top):
+            print('%14d 0x%-16x %-8s %s' % (retained[i], dump.addresses[i],
+                                            dump.type_name(i), dump.class_name(i)))
+    else:
+        print('%12s %14s  %-8s %s' % ('count', 'bytes', 'type', 'class'))
+        for tname, cname, count, size in dump.by_class(args.processes)[:args.top]:
+            print('%12d %14d  %-8s %s' % (count, size, tname, cname))
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,15 @@ class ArrayTest(gdbtest.GDBTest):
         self.assertIsInstance(rval, rugdby.RubyRArray)
         self.assertPretty(val, '[1, 2, 3]')
 
+    def test_embedded_long(self):
+        # 3.2+ can embed more than three elements, with a wider length
+        # field in the flags
+        val = gdb.parse_and_eval('rb_eval_string("[1, 2, 3, 4, 5]")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual(5, rval.length())
+        self.assertEqual([1, 2, 3, 4, 5], rval.proxyval(set()))
+        self.assertPretty(val, '[1, 2, 3, 4, 5]')
+
     def test_non_embedded(self):
         val = gdb.parse_and_eval('rb_eval_string("[1] * 100")')
         rval = rugdby.RubyVALUE.from_value(val)
@@ -21,3 +30,40 @@ class ArrayTest(gdbtest.GDBTest):
     def test_self_referential(self):
         val = gdb.parse_and_eval('rb_eval_string("x = [1]; x << x; x")')
         self.assertPretty(val, "[1, [...]]")
+
+    def test_immediates(self):
+        val = gdb.parse_and_eval('rb_eval_string("[-1, 2.5, 3]")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual([-1, 2.5, 3], rval.proxyval(set()))
+
+    def test_children(self):
+        val = gdb.parse_and_eval('rb_eval_string("[1] * 1000")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual('array', rval.display_hint)
+        children = rval.children()
+        name, child = next(children)
+        self.assertEqual('[0]', name)
+        self.assertEqual(1, rugdby.RubyVALUE.proxyval_from_value(child))
+        self.assertEqual(999, len(list(children)))
+
+    def test_truncated(self):
+        val = gdb.parse_and_eval('rb_eval_string("[1] * 100000")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual('[1, 1, 1, 1, 1, 1, 1...(truncated)', rval.get_truncated_repr(20))
+
+    def test_element_reprs(self):
+        # Elements print just as they do at the top level
+        val = gdb.parse_and_eval(
+            '''rb_eval_string("[nil, true, false, 'a', :b, Rational(3, 4), Complex.rect(1, 2), {1 => nil}]")''')
+        self.assertPretty(val, "[nil, true, false, 'a', :b, Fraction(3, 4), (1+2j), {1 => nil}]")
+
+    def test_deeply_nested(self):
+        val = gdb.parse_and_eval('rb_eval_string("x = [1]; 5000.times { x = [x] }; x")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        proxy = rval.proxyval(set())
+        for _ in range(5000):
+            proxy = proxy[0]
+        self.assertEqual([1], proxy)
+        # Three levels of arrays, then the marker
+        self.assertEqual('[[[[...]]]]', rval.get_truncated_repr(1024, max_depth=3))
+        self.assertEqual('[[[[...]]]]', repr(rugdby.RubyVALUE.proxyval_from_value(val, max_depth=3)))
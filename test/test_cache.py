@@ -0,0 +1,47 @@
+from __future__ import print_function
+
+import gdb
+import rugdby
+
+from test.lib import gdbtest
+
+class CacheScopeTest(gdbtest.GDBTest):
+    def counter(self, memoize, **kwargs):
+        """A memoized function that returns how often it's been called"""
+        calls = []
+        @memoize(**kwargs)
+        def f(*args):
+            calls.append(args)
+            return len(calls)
+        return f
+
+    def test_invalidate_clears_children(self):
+        objfile = rugdby.CacheScope('test-objfile')
+        inferior = rugdby.CacheScope('test-inferior', objfile)
+        stop = rugdby.CacheScope('test-stop', inferior)
+        fs = [self.counter(scope.memoize) for scope in (objfile, inferior, stop)]
+        self.assertEqual([1, 1, 1], [f() for f in fs])
+
+        inferior.invalidate()
+        self.assertEqual([1, 2, 2], [f() for f in fs])
+        objfile.invalidate()
+        self.assertEqual([2, 3, 3], [f() for f in fs])
+        stop.invalidate()
+        self.assertEqual([2, 3, 4], [f() for f in fs])
+
+    def test_stop_event(self):
+        fs = [self.counter(memoize) for memoize in
+              (rugdby.objfile_cache, rugdby.inferior_cache, rugdby.stop_cache)]
+        self.assertEqual([1, 1, 1], [f() for f in fs])
+        gdb.execute('stepi', to_string=True)
+        self.assertEqual([1, 1, 2], [f() for f in fs])
+
+    def test_lru(self):
+        f = self.counter(rugdby.CacheScope('test-lru').memoize, maxsize=2)
+        self.assertEqual(1, f('a'))
+        self.assertEqual(2, f('b'))
+        self.assertEqual(1, f('a'))
+        # 'b' is now the least recently used, so 'c' evicts it
+        self.assertEqual(3, f('c'))
+        self.assertEqual(1, f('a'))
+        self.assertEqual(4, f('b'))
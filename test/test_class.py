@@ -30,3 +30,24 @@ class ClassTest(gdbtest.GDBTest):
         rval = rugdby.RubyVALUE.from_value(val)
         self.assertEqual('A::B', rval.name())
         self.assertTrue(rval.validate_name('A::B'))
+
+    def test_name_anonymous(self):
+        val = gdb.parse_and_eval('rb_eval_string("Class.new")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual('Class:0x%x' % rval.as_address(), rval.name())
+
+    def test_constant_lookup(self):
+        # Indexed lookups must agree with a scan of the whole table
+        constants = rugdby.RubyRClass.cObject().constants()
+        for k, v in list(constants.items())[:50]:
+            self.assertEqual(v, constants[k])
+        self.assertRaises(KeyError, constants.__getitem__, 0)
+
+    def test_constant_values(self):
+        val = gdb.parse_and_eval('rb_eval_string("module ConstantValuesTest; X = 1; Y = :y; end; ConstantValuesTest")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        constants = dict(rval.constant_values())
+        self.assertEqual(2, len(constants))
+        x = constants[rugdby.RubySymbol.intern('X')]
+        self.assertEqual(1, rugdby.RubyVALUE.proxyval_from_value(x))
+        self.assertEqual(x, rugdby.RubyRClass.const_entry_value(rval.constants()[rugdby.RubySymbol.intern('X')]))
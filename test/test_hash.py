@@ -22,3 +22,55 @@ class HashTest(gdbtest.GDBTest):
     def test_self_referential(self):
         val = gdb.parse_and_eval('rb_eval_string("x = {}; x[:x] = x; x")')
         self.assertPretty(val, "{:x => {...}}")
+
+    def test_deleted(self):
+        val = gdb.parse_and_eval('rb_eval_string("h = Hash[(1..20).map { |i| [i, i * 2] }]; h.delete(5); h")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual(19, rval.size())
+        items = dict(rval.proxyval(set()))
+        self.assertEqual(19, len(items))
+        self.assertNotIn(5, items)
+        self.assertEqual(40, items[20])
+
+    def numtable(self, n):
+        """Build an st_table of n Fixnum-like keys in the inferior"""
+        for prefix in ('rb_st_', 'st_'):
+            try:
+                gdb.parse_and_eval(prefix + 'init_numtable')
+                break
+            except gdb.error:
+                continue
+        table = int(gdb.parse_and_eval('%sinit_numtable()' % (prefix,)))
+        for i in range(n):
+            gdb.parse_and_eval('%sinsert((st_table *)%d, %d, %d)' % (prefix, table, 2 * i + 1, i))
+        return rugdby.RubySTTable(gdb.Value(table).cast(rugdby.RubySTTable.get_gdb_type()))
+
+    def index_lookup(self, table, key):
+        if rugdby.RubySTTable.layout_kind() == 'open':
+            return table._open_lookup(key)
+        return table._chained_lookup(key)
+
+    def test_st_lookup(self):
+        table = self.numtable(100)
+        items = dict(table.items())
+        self.assertEqual(100, len(items))
+        # Lookups through the bins agree with a scan
+        for k, v in items.items():
+            self.assertEqual(v, self.index_lookup(table, k))
+            self.assertEqual(v, table[k])
+        self.assertIsNotNone(table.hash_function(lambda: []))
+        self.assertRaises(KeyError, table.__getitem__, 2)
+        self.assertRaises(KeyError, table.__getitem__, 1001)
+
+    def test_st_lookup_unknown_hash(self):
+        table = self.numtable(100)
+        hash_type = table.field('type')
+        # As if the table's hash function were none we know
+        rugdby.st_hash_functions[hash_type] = None
+        try:
+            self.assertIs(rugdby.ST_NO_INDEX, self.index_lookup(table, 1))
+            self.assertEqual(0, table[1])
+            self.assertEqual(99, table[199])
+            self.assertRaises(KeyError, table.__getitem__, 2)
+        finally:
+            del rugdby.st_hash_functions[hash_type]
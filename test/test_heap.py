@@ -0,0 +1,89 @@
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+import gdb
+import rugdby
+
+from test.lib import gdbtest
+
+class HeapTest(gdbtest.GDBTest):
+    def test_objects(self):
+        val = gdb.parse_and_eval('rb_eval_string("$rugdby_heap_test = \'heap test\'")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        addresses = set(address for _, address, _, _, _ in rugdby.RubyHeap.current().objects())
+        self.assertIn(rval.as_address(), addresses)
+
+    def test_stats(self):
+        gdb.parse_and_eval('rb_eval_string("class HeapStatsTest; end; $x = Array.new(1000) { HeapStatsTest.new }")')
+        out = gdb.execute('ruby-heap-stats', to_string=True)
+        row = [line for line in out.splitlines() if line.endswith(' HeapStatsTest')]
+        self.assertEqual(1, len(row))
+        self.assertGreaterEqual(int(row[0].split()[0]), 1000)
+        self.assertIn(' total', out.splitlines()[-1])
+
+    def test_dump(self):
+        val = gdb.parse_and_eval('rb_eval_string("$rugdby_dump_test = [\'dump test\']")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            gdb.execute('ruby-dump-heap %s' % (path,), to_string=True)
+            with open(path) as f:
+                records = dict((r.get('address'), r) for r in map(json.loads, f))
+        finally:
+            os.unlink(path)
+
+        array = records['0x%x' % rval.as_address()]
+        self.assertEqual('ARRAY', array['type'])
+        self.assertEqual(1, array['length'])
+        string = records[array['references'][0]]
+        self.assertEqual('STRING', string['type'])
+        self.assertEqual('dump test', string['value'])
+
+    def test_referrers(self):
+        string = gdb.parse_and_eval('rb_eval_string("$rugdby_referrers_test = [\'referred\']; $rugdby_referrers_test[0]")')
+        array = gdb.parse_and_eval('rb_eval_string("$rugdby_referrers_test")')
+        string_address = rugdby.RubyVALUE.from_value(string).as_address()
+        array_address = rugdby.RubyVALUE.from_value(array).as_address()
+
+        index = rugdby.RubyReferrerIndex.current()
+        self.assertIn(array_address, list(index.referrers(string_address)))
+        path = index.root_path(string_address)
+        self.assertEqual([array_address, string_address], path[-2:])
+
+        out = gdb.execute('ruby-referrers 0x%x' % (string_address,), to_string=True)
+        self.assertIn('0x%x ARRAY Array' % (array_address,), out)
+
+    def test_diff(self):
+        gdb.execute('ruby-heap-snapshot before', to_string=True)
+        gdb.parse_and_eval('rb_eval_string("class HeapDiffTest; end; $y = Array.new(500) { HeapDiffTest.new }")')
+        gdb.execute('ruby-heap-snapshot after', to_string=True)
+
+        before = rugdby.heap_snapshots['before']
+        after = rugdby.heap_snapshots['after']
+        self.assertEqual(500, after.class_counts()[('OBJECT', 'HeapDiffTest')])
+        self.assertNotIn(('OBJECT', 'HeapDiffTest'), before.class_counts())
+        new = [key for _, key in after.new_objects(before)]
+        self.assertEqual(500, new.count(('OBJECT', 'HeapDiffTest')))
+
+        out = gdb.execute('ruby-heap-diff before after', to_string=True)
+        row = [line for line in out.splitlines() if line.endswith(' HeapDiffTest')]
+        self.assertEqual('+500', row[0].split()[2])
+
+    def test_class_names(self):
+        val = gdb.parse_and_eval('rb_eval_string("$rugdby_class_names_test = \'class names\'")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        class_names = rugdby.RubyClassNames()
+        self.assertEqual('String', class_names(rval.klass()))
+        # Not a class, or not from an object whose klass is a class
+        self.assertIsNone(class_names(rval.as_address()))
+        self.assertIsNone(class_names(rval.as_address() + 1))
+        self.assertIsNone(class_names(rval.klass(), rugdby.type_code(rugdby.RUBY_T_NODE)))
+
+        for _, address, flags, klass, _ in rugdby.RubyHeap.current().objects():
+            t = flags & rugdby.RUBY_T_MASK
+            if t in rugdby.classless_types():
+                self.assertIsNone(class_names(klass, t))
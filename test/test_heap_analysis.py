@@ -0,0 +1,99 @@
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+import unittest
+
+import rugdby_heap
+
+# root -> a -> b -> c, root -> d -> c, plus an unreferenced e -> b
+# and a garbage cycle f <-> g. (These sizes were picked so every
+# retained size is distinct.)
+OBJECTS = [
+    ('0x1000', 'OBJECT', 'A', 10, ['0x2000']),
+    ('0x2000', 'ARRAY', None, 20, ['0x3000']),
+    ('0x3000', 'STRING', None, 40, []),
+    ('0x4000', 'OBJECT', 'A', 80, ['0x3000', '0x9999']),
+    ('0x5000', 'HASH', None, 160, ['0x2000']),
+    ('0x6000', 'OBJECT', 'B', 320, ['0x7000']),
+    ('0x7000', 'OBJECT', 'B', 640, ['0x6000']),
+]
+
+class HeapAnalysisTest(unittest.TestCase):
+    def write_dump(self, objects):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps({'type': 'ROOT', 'root': 'vm',
+                                'references': ['0x1000', '0x4000']}) + '\n')
+            for address, type, cname, memsize, refs in objects:
+                record = {'address': address, 'type': type, 'memsize': memsize,
+                          'references': refs}
+                if cname:
+                    record['class_name'] = cname
+                f.write(json.dumps(record) + '\n')
+        return path
+
+    def load(self, objects=OBJECTS, processes=1):
+        return rugdby_heap.HeapDump.load(self.write_dump(objects), processes)
+
+    def test_load(self):
+        dump = self.load()
+        self.assertEqual(7, len(dump))
+        i = dump.index(0x4000)
+        self.assertEqual('OBJECT', dump.type_name(i))
+        self.assertEqual('A', dump.class_name(i))
+        # The reference to 0x9999 isn't in the dump
+        self.assertEqual([dump.index(0x3000)], list(dump.references(i)))
+        self.assertRaises(KeyError, dump.index, 0x9999)
+
+    def test_unsorted(self):
+        dump = self.load(list(reversed(OBJECTS)))
+        self.assertEqual(sorted(dump.addresses), list(dump.addresses))
+        self.assertEqual([dump.index(0x2000)], list(dump.references(dump.index(0x1000))))
+
+    def test_unsorted_chunks(self):
+        # Many chunks, each out of order, merged back into address order
+        chunk_bytes = rugdby_heap.MAX_CHUNK_BYTES
+        rugdby_heap.MAX_CHUNK_BYTES = 200
+        try:
+            dump = self.load([OBJECTS[i] for i in (3, 6, 0, 5, 1, 4, 2)])
+        finally:
+            rugdby_heap.MAX_CHUNK_BYTES = chunk_bytes
+        self.assertEqual(sorted(dump.addresses), list(dump.addresses))
+        self.assertEqual(list(self.load().edge_targets), list(dump.edge_targets))
+        self.assertEqual('A', dump.class_name(dump.index(0x4000)))
+
+    def test_by_class(self):
+        rows = self.load().by_class()
+        self.assertEqual(('OBJECT', 'B', 2, 960), rows[0])
+        self.assertIn(('OBJECT', 'A', 2, 90), rows)
+
+    def test_retained(self):
+        dump = self.load()
+        # c is reachable through both a and d, so only the root retains it
+        self.assertEqual(10, dump.retained_size(0x1000))
+        self.assertEqual(20, dump.retained_size(0x2000))
+        self.assertEqual(80, dump.retained_size(0x4000))
+        self.assertEqual([], dump.dominator_chain(0x3000))
+        # The garbage cycle hangs off whichever member was found first
+        self.assertEqual(960, max(dump.retained_size(0x6000), dump.retained_size(0x7000)))
+
+    def test_dominator_chain(self):
+        dump = self.load([
+            ('0x1000', 'OBJECT', 'A', 1, ['0x2000']),
+            ('0x2000', 'OBJECT', 'A', 2, ['0x3000']),
+            ('0x3000', 'OBJECT', 'A', 4, []),
+        ])
+        self.assertEqual([0x2000, 0x1000], dump.dominator_chain(0x3000))
+        self.assertEqual(7, dump.retained_size(0x1000))
+        self.assertEqual([dump.index(0x1000)], dump.top_retainers(1))
+
+    def test_processes(self):
+        serial = self.load()
+        parallel = self.load(processes=2)
+        self.assertEqual(list(serial.addresses), list(parallel.addresses))
+        self.assertEqual(list(serial.edge_targets), list(parallel.edge_targets))
+        self.assertEqual(serial.by_class(1), parallel.by_class(2))
+        self.assertEqual(list(serial.retained_sizes()), list(parallel.retained_sizes()))
@@ -0,0 +1,48 @@
+from __future__ import print_function
+
+import gdb
+import rugdby
+
+from test.lib import gdbtest
+
+class ImmediatesTest(gdbtest.GDBTest):
+    def word(self, expr):
+        return int(gdb.parse_and_eval('rb_eval_string("%s")' % expr))
+
+    def assertImmediate(self, expr, t, proxy):
+        word = self.word(expr)
+        self.assertEqual(t, rugdby.immediates().type(word))
+        self.assertEqual(proxy, rugdby.immediates().proxyval(word))
+
+    def test_specials(self):
+        self.assertImmediate('nil', rugdby.RUBY_T_NIL, None)
+        self.assertImmediate('true', rugdby.RUBY_T_TRUE, True)
+        self.assertImmediate('false', rugdby.RUBY_T_FALSE, False)
+        self.assertEqual(rugdby.RUBY_T_UNDEF, rugdby.immediates().type(rugdby.Qundef()))
+
+    def test_nil_is_special_const(self):
+        val = gdb.parse_and_eval('rb_eval_string("nil")')
+        self.assertTrue(rugdby.RubyVALUE(val).is_special_const())
+        self.assertTrue(rugdby.RubyVALUE(gdb.Value(rugdby.Qundef())).is_special_const())
+
+    def test_fixnums(self):
+        self.assertImmediate('0', rugdby.RUBY_T_FIXNUM, 0)
+        self.assertImmediate('42', rugdby.RUBY_T_FIXNUM, 42)
+        self.assertImmediate('-42', rugdby.RUBY_T_FIXNUM, -42)
+
+    def test_static_symbol(self):
+        word = self.word(':rugdby_immediates_test')
+        self.assertEqual(rugdby.RUBY_T_SYMBOL, rugdby.immediates().type(word))
+        self.assertEqual('rugdby_immediates_test', str(rugdby.immediates().proxyval(word)))
+
+    def test_flonums(self):
+        if not rugdby.immediates().flonum_mask:
+            self.skipTest('Ruby was built without flonums')
+        self.assertImmediate('1.5', rugdby.RUBY_T_FLOAT, 1.5)
+        self.assertImmediate('-2.25', rugdby.RUBY_T_FLOAT, -2.25)
+        self.assertImmediate('0.0', rugdby.RUBY_T_FLOAT, 0.0)
+
+    def test_heap_object(self):
+        word = self.word("'not immediate'")
+        self.assertIsNone(rugdby.immediates().type(word))
+        self.assertIs(rugdby.NOT_IMMEDIATE, rugdby.immediates().proxyval(word))
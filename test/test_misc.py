@@ -17,3 +17,72 @@ class MiscTest(gdbtest.GDBTest):
     def test_non_values(self):
         val = gdb.parse_and_eval('(ID)23')
         self.assertPretty(val, '23')
+
+    def test_struct_layout(self):
+        layout = rugdby.struct_layout('struct RString')
+        self.assertEqual(0, layout.offset('basic.flags'))
+        self.assertEqual(gdb.lookup_type('struct RString').sizeof, layout.sizeof)
+        self.assertIsNone(rugdby.struct_layout('struct rugdby_no_such_struct'))
+
+    def test_raw_matches_gdb(self):
+        val = gdb.parse_and_eval('rb_eval_string("[1] * 100")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual(int(val.cast(gdb.lookup_type('struct RArray').pointer())['as']['heap']['len']),
+                         rval.field('as.heap.len'))
+
+    def test_detect_immediates(self):
+        # Every way of working out the encoding without running code in
+        # the inferior has to agree with actually running it
+        live = rugdby._immediates_from_inferior()
+        self.assertIsNotNone(live)
+        self.assertIsNotNone(rugdby.ruby_version())
+        for detect in (rugdby._immediates_from_debug_info, rugdby._immediates_from_version):
+            profile = detect()
+            if profile is None:
+                continue
+            self.assertEqual((live.qtrue, live.qnil), (profile.qtrue, profile.qnil))
+            self.assertEqual(live.qundef, profile.qundef)
+            self.assertEqual(live.symbol_flag, profile.symbol_flag)
+        self.assertEqual(int(gdb.parse_and_eval('rb_equal(0, 0)')), rugdby.Qtrue())
+
+    def test_ruby_seen(self):
+        self.assertTrue(rugdby.ruby_seen)
+        self.assertTrue(any(rugdby.is_ruby_objfile(o) for o in gdb.objfiles()))
+
+    def test_backtrace(self):
+        frames = rugdby.RubyExecutionContext.current().frames()
+        self.assertIn('-e', [f.path for f in frames])
+        self.assertIn("-e:1:in `", gdb.execute('ruby-bt', to_string=True))
+        # The second time round everything comes out of the iseq cache
+        self.assertEqual([str(f) for f in frames],
+                         [str(f) for f in rugdby.RubyExecutionContext.current().frames()])
+
+    def test_frame_filter(self):
+        if not hasattr(rugdby, 'RubyFrameFilter'):
+            self.skipTest('gdb has no frame filters')
+        # reg_cfp may not be set up yet at the breakpoint, but the
+        # filter mustn't get in the way of bt either way
+        self.assertIn('vm_exec_core', gdb.execute('bt 1', to_string=True))
+        cfp = rugdby.RubyExecutionContext.current().cfp
+        self.assertEqual('-e', rugdby.control_frame_at(cfp).path)
+
+    def test_undetectable_immediates(self):
+        def immediates():
+            raise RuntimeError("Unable to determine how this Ruby encodes immediates")
+        detected = rugdby.immediates
+        rugdby.immediates = immediates
+        try:
+            val = gdb.parse_and_eval('rb_eval_string("[1]")')
+            self.assertPretty(val, 'VALUE 0x%x' % int(val))
+        finally:
+            rugdby.immediates = detected
+
+    def test_nested_complex(self):
+        val = gdb.parse_and_eval('rb_eval_string("[Complex.rect(1, -2), Complex.rect(0, 1), Complex.rect(1.5, 2.0)]")')
+        self.assertPretty(val, repr([complex(1, -2), complex(0, 1), complex(1.5, 2.0)]))
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual('[(1-2j)...(truncated)', rval.get_truncated_repr(7))
+
+    def test_rational_complex(self):
+        val = gdb.parse_and_eval('rb_eval_string("Complex.rect(3, Rational(1, 2))")')
+        self.assertPretty(val, 'complex(3, Fraction(1, 2))')
@@ -20,3 +20,29 @@ class ObjectTest(gdbtest.GDBTest):
     def test_self_reference(self):
         val = gdb.parse_and_eval("""rb_eval_string("class Test; end; x = Test.new; x.instance_variable_set(:@foo, x); x")""")
         self.assertPretty(val, "<Test @foo=<...>>")
+
+    def test_object_cache(self):
+        val = gdb.parse_and_eval("""rb_eval_string("class Test; end; Test.new")""")
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertIs(rval, rugdby.RubyVALUE.from_value(val))
+        rugdby.STOP_SCOPE.invalidate()
+        self.assertIsNot(rval, rugdby.RubyVALUE.from_value(val))
+
+    def test_ivar_order(self):
+        val = gdb.parse_and_eval("""rb_eval_string("class Test; end; x = Test.new; x.instance_variable_set(:@b, 1); x.instance_variable_set(:@a, 2); x")""")
+        rval = rugdby.RubyVALUE.from_value(val)
+        if rugdby.shape_layout() is not None:
+            self.assertEqual(2, rval.numiv())
+        self.assertEqual(['@b', '@a'], [str(k) for k, _ in rval.ivars()])
+
+    def test_ivars_unavailable(self):
+        def ivars(self):
+            raise RuntimeError("Can't find where this Ruby keeps ivars")
+            yield
+        val = gdb.parse_and_eval("""rb_eval_string("class Test; end; Test.new")""")
+        original = rugdby.RubyRObject.ivars
+        rugdby.RubyRObject.ivars = ivars
+        try:
+            self.assertPretty(val, '<Test (ivars unavailable)>')
+        finally:
+            rugdby.RubyRObject.ivars = original
@@ -1,5 +1,8 @@
 from __future__ import print_function
 
+import os
+import tempfile
+
 import gdb
 import rugdby
 
@@ -12,6 +15,8 @@ class StringTest(gdbtest.GDBTest):
         rval = rugdby.RubyVALUE.from_value(val)
         self.assertIsInstance(rval, rugdby.RubyRString)
         self.assertFalse(rval.flags() & rugdby.RubyRString.RSTRING_NOEMBED())
+        self.assertIn(rugdby.RubyRString.embed_ary_path(), rugdby.struct_layout('struct RString'))
+        self.assertEqual(s.encode('ascii'), rval.contents())
         self.assertPretty(val, repr(s))
 
     def test_pretty_long_string(self):
@@ -21,3 +26,42 @@ class StringTest(gdbtest.GDBTest):
         self.assertIsInstance(rval, rugdby.RubyRString)
         self.assertTrue(rval.flags() & rugdby.RubyRString.RSTRING_NOEMBED())
         self.assertPretty(val, repr(s))
+
+    def test_pretty_binary_string(self):
+        val = gdb.parse_and_eval('rb_eval_string("[104, 105, 255].pack(\'C*\')")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        self.assertEqual('ASCII-8BIT', rval.encoding())
+        # Each byte is one character, and both printers agree on it
+        proxy = rval.proxyval(set())
+        self.assertEqual(b'hi\xff', proxy if isinstance(proxy, bytes) else proxy.encode('latin-1'))
+        self.assertEqual(repr(proxy), rval.get_truncated_repr(1024))
+        self.assertPretty(val, repr(proxy))
+        ary = gdb.parse_and_eval('rb_eval_string("[[104, 105, 255].pack(\'C*\')]")')
+        self.assertPretty(ary, repr([proxy]))
+
+    def test_truncated_read(self):
+        val = gdb.parse_and_eval('rb_eval_string("\'x\' * 1000000")')
+        rval = rugdby.RubyVALUE.from_value(val)
+        out = rugdby.TruncatedStringIO(10)
+        self.assertRaises(rugdby.StringTruncated, rval.write_repr, out, set())
+        self.assertEqual("'xxxxxxxxx", out.getvalue())
+
+    def test_save(self):
+        val = gdb.parse_and_eval('rb_eval_string("\'abc\' * 1000")')
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            gdb.execute('ruby-save-string (VALUE)%d %s' % (int(val), path), to_string=True)
+            with open(path, 'rb') as f:
+                self.assertEqual(b'abc' * 1000, f.read())
+        finally:
+            os.unlink(path)
+
+    def test_memoized_contents(self):
+        # Cached wrappers mustn't pin the contents of big strings
+        short = rugdby.RubyVALUE.from_value(gdb.parse_and_eval('rb_eval_string("\'abc\'")'))
+        long = rugdby.RubyVALUE.from_value(gdb.parse_and_eval('rb_eval_string("\'x\' * 100000")'))
+        self.assertEqual('abc', str(short))
+        self.assertEqual(100000, len(str(long)))
+        self.assertEqual('abc', short._str)
+        self.assertIsNone(long._str)
@@ -18,3 +18,17 @@ class SymbolTest(gdbtest.GDBTest):
         rval = rugdby.RubyVALUE.from_value(val)
         self.assertIsInstance(rval, rugdby.RubySymbol)
         self.assertPretty(val, ':<Unknown symbol ID 0x%x>' % 0xbeef)
+
+    def test_intern(self):
+        gdb.parse_and_eval('rb_eval_string(":rugdby_intern_test")')
+        id = rugdby.RubySymbol.intern('rugdby_intern_test')
+        self.assertIsNotNone(id)
+        self.assertEqual('rugdby_intern_test', str(rugdby.RubyID(gdb.Value(id))))
+        self.assertIsNone(rugdby.RubySymbol.intern('rugdby missing symbol'))
+
+    def test_symbol_table(self):
+        self.assertIn(rugdby.RubyID.global_symbols_expression(),
+                      rugdby.RubyID.GLOBAL_SYMBOLS_EXPRESSIONS)
+        id = rugdby.RubySymbol.intern('object_id')
+        self.assertIsNotNone(id)
+        self.assertEqual('object_id', str(rugdby.RubyID(id)))